@@ -35,13 +35,67 @@ const els = {
 let db = null;
 let session = null;
 
+// The builder writes data/quiz/manifest.json (titles, labels, one preview per set)
+// and one file per set, fetched only when that set is played. Without the manifest
+// the app falls back to the single isic_quiz_sets.json with every set inline.
+const QUIZ_BASE = './data/quiz';
+
+// Derivatives from the builder (--derivatives): images[use] = [{ width, height, avif?, webp }].
+// Cases without them keep using imageUrl.
+const IMAGE_FORMATS = ['avif', 'webp'];
+
+function showImage(img, item, use, sizes) {
+  const picture = img.parentElement;
+  if (picture && picture.tagName === 'PICTURE') {
+    picture.querySelectorAll('source').forEach(s => s.remove());
+  }
+  const variants = item?.images?.[use] || [];
+  img.src = item.imageUrl;
+  if (!variants.length) {
+    img.removeAttribute('width');
+    img.removeAttribute('height');
+    return;
+  }
+  IMAGE_FORMATS.forEach(fmt => {
+    if (!picture || !variants.every(v => v[fmt])) return;
+    const source = document.createElement('source');
+    source.type = `image/${fmt}`;
+    source.srcset = variants.map(v => `${v[fmt]} ${v.width}w`).join(', ');
+    source.sizes = sizes;
+    picture.insertBefore(source, img);
+  });
+  // intrinsic size up front, so the layout does not jump when the image arrives
+  const largest = variants[variants.length - 1];
+  img.width = largest.width;
+  img.height = largest.height;
+}
+
 function labelsForQuestions(questions) {
   return [...new Set(questions.map(q => q.diagnosis))];
 }
 
-function startModuleSet(moduleKey, setIndex) {
-  const moduleSets = db.modules[moduleKey] || [];
-  const questions = moduleSets[setIndex] || [];
+// Set files are named by content, so a fetched set never goes stale during a visit.
+async function loadSet(set) {
+  if (!set.cases) {
+    const res = await fetch(`${QUIZ_BASE}/${set.file}`);
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    set.cases = (await res.json()).cases || [];
+  }
+  return set.cases;
+}
+
+async function startModuleSet(moduleKey, setIndex) {
+  const m = db.modules[moduleKey];
+  const set = m?.sets?.[setIndex];
+  let questions = [];
+  if (set) {
+    try {
+      questions = await loadSet(set);
+    } catch (e) {
+      alert('Deze quizset kon niet geladen worden. Probeer het opnieuw.');
+      return;
+    }
+  }
   if (!questions.length) {
     alert('Deze quizset is nog niet beschikbaar.');
     return;
@@ -50,7 +104,7 @@ function startModuleSet(moduleKey, setIndex) {
   session = {
     moduleKey,
     setIndex,
-    title: `${MODULES[moduleKey].title} · Ronde ${setIndex + 1}`,
+    title: `${m.title} · Ronde ${setIndex + 1}`,
     labels: labelsForQuestions(questions),
     questions,
     i: 0,
@@ -74,7 +128,7 @@ function renderQuestion() {
   els.quizProgress.textContent = `Vraag ${session.i + 1}/${session.questions.length}`;
   els.scoreNow.textContent = String(session.score);
 
-  els.lesionImage.src = q.imageUrl;
+  showImage(els.lesionImage, q, 'quiz', '(max-width: 700px) 100vw, 940px');
   els.lesionImage.alt = `ISIC ${q.id}`;
 
   els.answers.innerHTML = '';
@@ -137,20 +191,25 @@ function backToModules() {
 function renderModules() {
   els.modules.innerHTML = '';
 
-  Object.entries(MODULES).forEach(([key, m]) => {
-    const sets = db.modules[key] || [];
+  const keys = [...new Set([...Object.keys(MODULES), ...Object.keys(db.modules || {})])];
+  keys.forEach(key => {
+    const m = db.modules[key] || { title: MODULES[key]?.title || key, labels: [], sets: [] };
+    const sets = m.sets || [];
     const counts = (db.meta?.counts) || {};
 
     const card = document.createElement('div');
     card.className = 'module-btn';
 
-    const previewSrc = sets?.[0]?.[0]?.imageUrl;
-    if (previewSrc) {
+    const previewCase = m.preview;
+    if (previewCase?.imageUrl) {
+      const picture = document.createElement('picture');
       const img = document.createElement('img');
       img.className = 'module-preview';
-      img.src = previewSrc;
       img.alt = `${m.title} preview`;
-      card.appendChild(img);
+      img.loading = 'lazy';
+      picture.appendChild(img);
+      showImage(img, previewCase, 'preview', '(max-width: 700px) 100vw, 320px');
+      card.appendChild(picture);
     }
 
     const title = document.createElement('strong');
@@ -161,7 +220,7 @@ function renderModules() {
     meta.textContent = `${sets.length} vaste sets beschikbaar`;
     card.appendChild(meta);
 
-    const labels = [...new Set(sets.flat().map(x => x.diagnosis))];
+    const labels = m.labels || [];
     if (labels.length) {
       const labelMeta = document.createElement('span');
       labelMeta.style.display = 'block';
@@ -194,13 +253,47 @@ function renderModules() {
   });
 }
 
+// Output format 2 lists case ids per set next to one `cases` table; older files
+// embed the cases in every set. Either way the rest of the app sees full cases.
+function loadDb(raw) {
+  if (!raw || (raw.format || 1) < 2) return raw;
+  const cases = raw.cases || {};
+  const modules = {};
+  Object.entries(raw.modules || {}).forEach(([key, sets]) => {
+    modules[key] = sets.map(ids => ids.filter(id => cases[id]).map(id => ({ id, ...cases[id] })));
+  });
+  return { ...raw, modules };
+}
+
+// Same shape as the manifest, with the cases already in every set.
+function manifestFromDb(full) {
+  const modules = {};
+  Object.entries(full.modules || {}).forEach(([key, sets]) => {
+    modules[key] = {
+      title: MODULES[key]?.title || key,
+      labels: labelsForQuestions(sets.flat()),
+      preview: sets[0]?.[0],
+      sets: sets.map(cases => ({ size: cases.length, preview: cases[0], cases }))
+    };
+  });
+  return { meta: full.meta, modules };
+}
+
 async function boot() {
-  const res = await fetch('./data/isic_quiz_sets.json');
-  db = await res.json();
+  const res = await fetch(`${QUIZ_BASE}/manifest.json`).catch(() => null);
+  if (res?.ok) {
+    db = await res.json();
+  } else {
+    const full = await fetch('./data/isic_quiz_sets.json');
+    db = manifestFromDb(loadDb(await full.json()));
+  }
 
   // User request: remove Set 1 from BCC vs Bowen
-  if (Array.isArray(db?.modules?.bcc_vs_bowen) && db.modules.bcc_vs_bowen.length > 0) {
-    db.modules.bcc_vs_bowen = db.modules.bcc_vs_bowen.slice(1);
+  const bowen = db?.modules?.bcc_vs_bowen;
+  if (Array.isArray(bowen?.sets) && bowen.sets.length > 0) {
+    bowen.sets = bowen.sets.slice(1);
+    // the module preview came from the hidden set; show the first remaining one instead
+    bowen.preview = bowen.sets[0]?.preview || bowen.sets[0]?.cases?.[0] || null;
   }
 
   renderModules();
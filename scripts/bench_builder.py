@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Benchmarksuite voor de hot paths van build_isic_sets.py op synthetische
+ISIC-pagina's: add_case, harvest_label, build_sets, save_ck/load_ck en het
+wegschrijven van de quizsets.
+
+Per stap: doorvoer (records/s), piekgeheugen (tracemalloc) en, waar relevant,
+geschreven checkpoint-bytes. Resultaten gaan als JSON naar stdout of --out,
+zodat runs vergeleken kunnen worden.
+
+    python scripts/bench_builder.py --sizes 1000,100000,1000000 --out bench.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import build_isic_sets as builder
+from isic_ids import IdSet
+
+PAGE_SIZE = 200
+
+
+def make_record(k: int) -> dict:
+    # cheap and deterministic: ~1/3 clinical, ~1/10 non-dermoscopic, ~1/4 without lesion id, some repeat lesions
+    return {
+        'isic_id': f'ISIC_{k:07d}',
+        'files': {'full': {'url': f'https://isic-archive.s3.amazonaws.com/images/ISIC_{k:07d}.jpg'}},
+        'metadata': {
+            'acquisition': {'image_type': 'clinical: overview' if k % 10 == 9 else 'dermoscopic'},
+            'clinical': {
+                'diagnosis_3': 'Nevus',
+                'diagnosis_confirm_type': 'single image expert consensus' if k % 3 == 2 else 'histopathology',
+                'lesion_id': '' if k % 4 == 0 else f'IL_{k - k % 7:07d}',
+            },
+        },
+    }
+
+
+def make_page(n: int, page: int) -> dict:
+    start = page * PAGE_SIZE
+    stop = min(start + PAGE_SIZE, n)
+    nxt = f'bench://{page + 1}' if stop < n else None
+    return {'count': n, 'next': nxt, 'results': [make_record(k) for k in range(start, stop)]}
+
+
+def bytes_written() -> int:
+    # Linux: bytes handed to write(2) by this process
+    try:
+        for line in Path('/proc/self/io').read_text().splitlines():
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(fn, records: int, with_memory: bool = True) -> dict:
+    gc.collect()
+    w0 = bytes_written()
+    t0 = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - t0
+    w1 = bytes_written()
+    out = {
+        'records': records,
+        'seconds': round(elapsed, 4),
+        'records_per_s': round(records / elapsed) if elapsed > 0 else None,
+        'bytes_written': (w1 - w0) if w0 is not None and w1 is not None else None,
+    }
+    if with_memory:
+        # second run under tracemalloc so its overhead does not skew the timing
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        out['peak_mem_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return out
+
+
+def bench_add_case(n: int, mem: bool) -> dict:
+    def run():
+        bucket, seen_ids, seen_lesions, pool = [], IdSet(), IdSet(), []
+        for k in range(n):
+            builder.add_case(bucket, seen_ids, seen_lesions, 'nevus', make_record(k), clinical_pool=pool)
+    return measure(run, n, mem)
+
+
+def bench_harvest_label(n: int, mem: bool, tmp: Path) -> dict:
+    def fake_fetch(url, params=None, label=''):
+        return make_page(n, 0 if params else int(url.rsplit('/', 1)[-1]))
+
+    result = {}
+
+    def run():
+        ck = tmp / f'harvest_{n}.json'
+        for p in (ck, builder.ck_journal_path()):
+            if p.exists():
+                p.unlink()
+        builder.CK_PATH = ck
+        state = {}
+        bucket = builder.harvest_label('nevus', 'diagnosis_3:"Nevus"', state, n)
+        builder.save_ck(state)
+        result['cases'] = len(bucket)
+        result['checkpoint_bytes'] = ck.stat().st_size
+
+    builder.fetch_json = fake_fetch
+    out = measure(run, n, mem)
+    out.update(result)
+    out['pages'] = -(-n // PAGE_SIZE)
+    return out
+
+
+def synthetic_bucket(n: int, label: str, offset: int) -> list:
+    return [
+        {'id': f'ISIC_{offset + k:07d}', 'lesionId': '', 'imageUrl': f'u{k}', 'diagnosis': label, 'source': 'histopathology'}
+        for k in range(n)
+    ]
+
+
+def bench_build_sets(n: int, mem: bool) -> dict:
+    a = synthetic_bucket(n, 'melanoma', 0)
+    b = synthetic_bucket(n, 'nevus', n)
+    return measure(lambda: builder.build_sets(a, b, nsets=3), 2 * n, mem)
+
+
+def bench_checkpoint(n: int, mem: bool, tmp: Path) -> dict:
+    builder.CK_PATH = tmp / f'ck_{n}.json'
+    state = {'version': 4, 'buckets': {'nevus': synthetic_bucket(n, 'nevus', 0)}, 'next_nevus': 'bench://1'}
+    save = measure(lambda: builder.save_ck(state), n, mem)
+    save['checkpoint_bytes'] = builder.CK_PATH.stat().st_size
+    load = measure(builder.load_ck, n, mem)
+    return {'save_ck': save, 'load_ck': load}
+
+
+def bench_output(n: int, mem: bool, tmp: Path) -> dict:
+    # the final json.dumps(indent=2) + write in main, for n cases spread over modules
+    cases = synthetic_bucket(n, 'nevus', 0)
+    per_set = 10
+    payload = {'meta': {'counts': {'nevus': n}}, 'modules': {'bench': [cases[i:i + per_set] for i in range(0, n, per_set)]}}
+    out_path = tmp / f'out_{n}.json'
+    out = measure(lambda: out_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding='utf-8'), n, mem)
+    out['output_bytes'] = out_path.stat().st_size
+    return out
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--sizes', default='1000,100000,1000000')
+    ap.add_argument('--only', default='add_case,harvest_label,build_sets,checkpoint,output')
+    ap.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    ap.add_argument('--out', type=Path, help='write JSON results here as well')
+    args = ap.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',') if x]
+    only = set(args.only.split(','))
+    mem = not args.no_memory
+
+    # keep the benchmark hermetic: no archive, store, cache or network
+    builder.ARCHIVE = None
+    builder.STORE = None
+    builder.PREFETCH = False
+
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_rev': git_rev(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as d:
+        tmp = Path(d)
+        for n in sizes:
+            r = {}
+            if 'add_case' in only:
+                r['add_case'] = bench_add_case(n, mem)
+            if 'harvest_label' in only:
+                r['harvest_label'] = bench_harvest_label(n, mem, tmp)
+            if 'build_sets' in only:
+                r['build_sets'] = bench_build_sets(n, mem)
+            if 'checkpoint' in only:
+                r.update(bench_checkpoint(n, mem, tmp))
+            if 'output' in only:
+                r['output'] = bench_output(n, mem, tmp)
+            report['results'][str(n)] = r
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        args.out.write_text(text + '\n', encoding='utf-8')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
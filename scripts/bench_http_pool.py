@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark: losse requests.get() per pagina versus de gedeelde keep-alive
+client uit isic_http, tegen een lokale stand-in server.
+
+De stand-in serveert een ISIC-achtige zoekpagina (200 resultaten) en kan per
+nieuwe verbinding een handshake-vertraging simuleren (--handshake-ms), omdat
+een lokale HTTP-server zelf geen TLS-opbouw kost.
+
+    python scripts/bench_http_pool.py --pages 200 --handshake-ms 30
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import isic_http
+
+
+def fake_page(n: int = 200) -> bytes:
+    results = []
+    for i in range(n):
+        results.append({
+            'isic_id': f'ISIC_{i:07d}',
+            'files': {'full': {'url': f'https://isic-archive.s3.amazonaws.com/images/ISIC_{i:07d}.jpg'}},
+            'metadata': {
+                'acquisition': {'image_type': 'dermoscopic'},
+                'clinical': {'diagnosis_confirm_type': 'histopathology', 'lesion_id': f'IL_{i:07d}'},
+            },
+        })
+    return json.dumps({'count': n, 'next': None, 'results': results}).encode('utf-8')
+
+
+def make_server(body: bytes, handshake_ms: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # send headers and body in one segment; otherwise Nagle + delayed ACK
+        # adds ~40 ms to every keep-alive response
+        disable_nagle_algorithm = True
+        wbufsize = 64 * 1024
+
+        def setup(self):
+            super().setup()
+            if handshake_ms:
+                time.sleep(handshake_ms / 1000)
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(get, url: str, pages: int) -> list:
+    lat = []
+    for _ in range(pages):
+        t0 = time.perf_counter()
+        r = get(url)
+        r.raise_for_status()
+        r.json()
+        lat.append((time.perf_counter() - t0) * 1000)
+    return lat
+
+
+def summarize(name: str, lat: list) -> dict:
+    lat_sorted = sorted(lat)
+    return {
+        'client': name,
+        'pages': len(lat),
+        'mean_ms': round(statistics.mean(lat), 3),
+        'p50_ms': round(lat_sorted[len(lat) // 2], 3),
+        'p95_ms': round(lat_sorted[int(len(lat) * 0.95) - 1], 3),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--pages', type=int, default=200)
+    ap.add_argument('--handshake-ms', type=float, default=0.0, help='simulated per-connection setup cost')
+    args = ap.parse_args()
+
+    server = make_server(fake_page(), args.handshake_ms)
+    url = f'http://127.0.0.1:{server.server_address[1]}/api/v2/images/search/'
+    try:
+        plain = summarize('requests.get', run(lambda u: requests.get(u, timeout=45), url, args.pages))
+        pooled = summarize('isic_http', run(isic_http.get, url, args.pages))
+    finally:
+        isic_http.close()
+        server.shutdown()
+
+    report = {
+        'handshake_ms': args.handshake_ms,
+        'results': [plain, pooled],
+        'speedup_mean': round(plain['mean_ms'] / pooled['mean_ms'], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark: bijna-dubbel-detectie (isic_phash) zonder netwerk of schijf.
+
+- hash: gevectoriseerde pHash/dHash over N synthetische 32x32 / 9x8 grijsbeelden
+- check: N afbeeldingen met gecachete hashes door NearDuplicates (NumPy-scan),
+  met ~5% bijna-dubbelen; zo draait de near_dup-stap bij een herhaalde run
+- linear: dezelfde check als pure-Python scan, ter vergelijking
+
+    python scripts/bench_phash.py --sizes 1000,10000,100000
+"""
+
+import argparse
+import json
+import random
+import time
+
+import isic_phash
+
+
+def random_hashes(n: int, dup_rate: float = 0.05, seed: int = 11) -> list:
+    rnd = random.Random(seed)
+    out = []
+    for k in range(n):
+        if out and rnd.random() < dup_rate:
+            # flip a few bits of an earlier image
+            p, d = rnd.choice(out)[1]
+            for _ in range(rnd.randint(0, 4)):
+                p ^= 1 << rnd.randrange(64)
+                d ^= 1 << rnd.randrange(64)
+            out.append((f'ISIC_{k:07d}', (p, d)))
+        else:
+            out.append((f'ISIC_{k:07d}', (rnd.getrandbits(64), rnd.getrandbits(64))))
+    return out
+
+
+def bench_hash(n: int) -> dict:
+    np = isic_phash.np
+    rng = np.random.default_rng(3)
+    g32 = rng.random((n, 32, 32), dtype=np.float32) * 255
+    g98 = rng.random((n, 8, 9), dtype=np.float32) * 255
+    t0 = time.perf_counter()
+    for start in range(0, n, isic_phash.BATCH):
+        isic_phash.hash_arrays(g32[start:start + isic_phash.BATCH], g98[start:start + isic_phash.BATCH])
+    elapsed = time.perf_counter() - t0
+    return {'images': n, 'seconds': round(elapsed, 4), 'ms_per_1000': round(elapsed / n * 1e6, 2)}
+
+
+def bench_check(items: list) -> dict:
+    seen = isic_phash.NearDuplicates()
+    rejected = 0
+    t0 = time.perf_counter()
+    for case_id, h in items:
+        if seen.check(case_id, h) is not None:
+            rejected += 1
+        else:
+            seen.add(case_id, h)
+    elapsed = time.perf_counter() - t0
+    return {'images': len(items), 'rejected': rejected, 'seconds': round(elapsed, 4), 'ms_per_1000': round(elapsed / len(items) * 1e6, 2)}
+
+
+def bench_linear(items: list) -> dict:
+    accepted = []
+    rejected = 0
+    t0 = time.perf_counter()
+    for case_id, (p, d) in items:
+        if any(isic_phash.hamming(p, q) <= isic_phash.PHASH_RADIUS and isic_phash.hamming(d, e) <= isic_phash.DHASH_RADIUS
+               for q, e in accepted):
+            rejected += 1
+        else:
+            accepted.append((p, d))
+    elapsed = time.perf_counter() - t0
+    return {'images': len(items), 'rejected': rejected, 'seconds': round(elapsed, 4), 'ms_per_1000': round(elapsed / len(items) * 1e6, 2)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--sizes', default='1000,10000,100000')
+    ap.add_argument('--linear-max', type=int, default=10000, help='skip the linear scan above this size')
+    args = ap.parse_args()
+    if not isic_phash.available():
+        ap.error('needs NumPy and Pillow')
+
+    report = {}
+    for n in [int(x) for x in args.sizes.split(',') if x]:
+        items = random_hashes(n)
+        r = {'hash': bench_hash(n), 'check': bench_check(items)}
+        if n <= args.linear_max:
+            r['linear'] = bench_linear(items)
+        report[str(n)] = r
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
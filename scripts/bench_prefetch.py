@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark: harvest_label met en zonder read-ahead (PREFETCH) op vastgelegde
+pagina's, met gesimuleerde netwerklatentie per pagina.
+
+Fixtures zijn een map met page-0000.json, page-0001.json, ... in cursorvolgorde;
+zonder --fixtures worden synthetische ISIC-pagina's gegenereerd.
+
+    python scripts/bench_prefetch.py --latency-ms 150 --pages 40
+"""
+
+import argparse
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import build_isic_sets as builder
+
+
+def synthetic_pages(n_pages: int, per_page: int = 200, seed: int = 7) -> list:
+    rnd = random.Random(seed)
+    pages = []
+    for p in range(n_pages):
+        results = []
+        for i in range(per_page):
+            k = p * per_page + i
+            results.append({
+                'isic_id': f'ISIC_{k:07d}',
+                'files': {'full': {'url': f'https://isic-archive.s3.amazonaws.com/images/ISIC_{k:07d}.jpg'}},
+                'metadata': {
+                    'acquisition': {'image_type': rnd.choice(['dermoscopic', 'clinical: overview'])},
+                    'clinical': {
+                        # scarce label: few histopathology-confirmed, unique lesions per page
+                        'diagnosis_confirm_type': 'histopathology' if rnd.random() < 0.01 else 'single image expert consensus',
+                        'lesion_id': f'IL_{rnd.randint(0, 10 ** 6):07d}',
+                    },
+                },
+            })
+        pages.append({'count': n_pages * per_page, 'next': f'fixture://{p + 1}' if p + 1 < n_pages else None, 'results': results})
+    return pages
+
+
+def load_fixtures(path: Path) -> list:
+    pages = [json.loads(p.read_text(encoding='utf-8')) for p in sorted(path.glob('page-*.json'))]
+    # re-link the cursor chain so replay never leaves the fixture set
+    for i, page in enumerate(pages):
+        page['next'] = f'fixture://{i + 1}' if i + 1 < len(pages) else None
+    return pages
+
+
+def run(pages: list, latency: float, prefetch: bool, target: int) -> dict:
+    calls = []
+
+    def fake_fetch(url, params=None, label=''):
+        calls.append(url)
+        time.sleep(latency)
+        return pages[0] if params else pages[int(url.rsplit('/', 1)[-1])]
+
+    builder.fetch_json = fake_fetch
+    builder.PREFETCH = prefetch
+    with tempfile.TemporaryDirectory() as tmp:
+        builder.CK_PATH = Path(tmp) / 'isic_checkpoint.json'
+        t0 = time.perf_counter()
+        bucket = builder.harvest_label('bench', 'diagnosis_3:"Bench"', {}, target)
+        elapsed = time.perf_counter() - t0
+    return {'prefetch': prefetch, 'seconds': round(elapsed, 3), 'requests': len(calls), 'cases': len(bucket)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--fixtures', type=Path, help='directory with recorded page-*.json files')
+    ap.add_argument('--pages', type=int, default=40, help='synthetic pages when no fixtures are given')
+    ap.add_argument('--latency-ms', type=float, default=150.0)
+    ap.add_argument('--target', type=int, default=10 ** 6, help='default walks the whole chain')
+    args = ap.parse_args()
+
+    pages = load_fixtures(args.fixtures) if args.fixtures else synthetic_pages(args.pages)
+    latency = args.latency_ms / 1000
+    seq = run(pages, latency, False, args.target)
+    pre = run(pages, latency, True, args.target)
+    assert seq['cases'] == pre['cases']
+    print(json.dumps({
+        'pages': len(pages),
+        'latency_ms': args.latency_ms,
+        'results': [seq, pre],
+        'speedup': round(seq['seconds'] / pre['seconds'], 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,22 +8,99 @@ Belangrijk:
 - Alleen histopathology-geverifieerde laesies
 - Vaste (deterministische) quizsets, geen random
 - Meerdere sets per module
+
+Gebruik (zie --help):
+    python scripts/build_isic_sets.py --out-dir data --target 15
+    python scripts/build_isic_sets.py --out-dir data --modules bcc_vs_sh --only-build
+    python scripts/build_isic_sets.py --out-dir data --only-build --mirror   # images -> data/images
+    python scripts/build_isic_sets.py --out-dir data --only-build --derivatives   # + WebP/AVIF sizes (Pillow)
+    python scripts/build_isic_sets.py --out-dir data --only-build --near-dup   # skip near-duplicate images (NumPy)
+    python scripts/build_isic_sets.py --out-dir data --only-build --derivatives --pack   # one images.pack file
+    python scripts/isic_pack.py --pack data/images.pack --root .   # serve the app and the pack
 """
 
+import argparse
+import hashlib
 import json
+import os
+import queue
+import re
+import threading
 import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager, nullcontext
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, List
 
-import requests
+import isic_derivatives
+import isic_http
+import isic_mirror
+import isic_pack
+import isic_phash
+import isic_profile
+import isic_store
+from isic_ids import Case, IdSet, json_default
+from isic_metrics import FILTER_ORDER, METRICS
+from isic_stream import StreamedPage
 
-BASE = Path('/home/tobias/.openclaw/workspace/dermatoscopie-oefenplatform/data')
+BASE = Path(__file__).resolve().parent.parent / 'data'  # data/ next to index.html
 OUT_PATH = BASE / 'isic_quiz_sets.json'
+OUTPUT_FORMAT = 2  # 2: one cases table keyed by id, sets list ids; 1: full cases inside every set (older app.js)
+QUIZ_DIR = BASE / 'quiz'  # manifest.json + one file per set, loaded lazily by app.js; None disables
 CK_PATH = BASE / 'isic_checkpoint.json'
+CK_COMPACT_EVERY = 256  # journal entries between full snapshots
+STORE_PATH = None  # e.g. BASE / 'isic_candidates.sqlite': keep buckets in SQLite instead of the checkpoint
+ARCHIVE_DIR = BASE / 'raw_archive'  # full API records, for offline rebuilds; None disables
+OFFLINE = False  # rebuild from ARCHIVE_DIR only: no network, no checkpoint
+METRICS_PATH = BASE / 'harvest_metrics.json'  # per-run JSON report; None disables
+HISTORY_PATH = BASE / 'harvest_history.json'  # acceptance per label and request latency of the runs that harvested, for --plan
+METRICS_PROM_PATH = None  # optional Prometheus textfile, e.g. /var/lib/node_exporter/isic_builder.prom
+CACHE_DIR = BASE / 'http_cache'  # None disables the response cache
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+MIRROR_DIR = None  # e.g. BASE / 'images': download quiz images and point imageUrl at the local copies
+MIRROR_URL_PREFIX = 'data/images'  # how the front-end (index.html) reaches MIRROR_DIR
+MIRROR_WORKERS = 8
+DERIVATIVES = False  # WebP/AVIF thumbnails, previews and quiz sizes from the mirror (needs Pillow)
+DERIVATIVE_WORKERS = None  # processes; None = one per CPU
+PACK_PATH = None  # e.g. BASE / 'images.pack': all mirrored images and derivatives in one file (scripts/isic_pack.py serves it)
+PACK_URL_PREFIX = 'pack'  # where isic_pack.py serves the pack, relative to index.html
+NEAR_DUP = False  # drop set candidates whose image is a perceptual near-duplicate of an earlier one (needs NumPy + Pillow)
+NEAR_DUP_ROUNDS = 3  # extra harvests per run to replace rejected near-duplicates
 
-SEARCH_URL = 'https://api.isic-archive.com/api/v2/images/search/'
+# point at a local stand-in (scripts/isic_standin.py) for offline benchmarking
+SEARCH_URL = os.environ.get('ISIC_SEARCH_URL', 'https://api.isic-archive.com/api/v2/images/search/')
 RETRIES = 5
+PAGE_SIZE = 200  # results per search page
+REQUESTS_PER_SECOND = 12.0  # shared across all harvest threads; halves on 429/503
 TARGET_PER_LABEL = 15  # 3 sets x 5 per label
+HARVEST_WORKERS = 6  # labels harvested in parallel; 1 = sequential
+HARVEST_MODE = 'per_label'  # 'multiplex': one OR query, results routed to buckets by diagnosis
+PREFETCH = True  # fetch cursor page N+1 while page N is being filtered
+STREAM = False  # parse search pages while they download (isic_stream) instead of after
+PARTITIONS = 1  # >1: split each per-label query into isic_id ranges whose cursor chains are walked concurrently
+PARTITION_WINDOW = 4  # partitions in flight at once, counted from the one being consumed
+PARTITION_BUFFER = 4  # pages a partition may fetch before the merge reaches it
+ID_SPACE = 10 ** 7  # ISIC_0000000 .. ISIC_9999999
+
+# guards the shared checkpoint state when labels are harvested concurrently
+CK_LOCK = threading.Lock()
+STORE = None  # isic_store.CandidateStore, opened by main when STORE_PATH is set
+ARCHIVE = None  # isic_store.RawArchive, opened by main when ARCHIVE_DIR is set
+PROFILER = None  # isic_profile.StageProfiler, set by main for --profile
+
+MODULES = {
+    'mel_vs_nevus': ('melanoma', 'nevus'),
+    'bcc_vs_sh': ('bcc', 'sebaceous_hyperplasia'),
+    'bcc_vs_bowen': ('bcc', 'bowen'),
+}
+MODULE_TITLES = {
+    'mel_vs_nevus': 'Melanoom vs Naevi',
+    'bcc_vs_sh': 'BCC vs Talgklierhyperplasie',
+    'bcc_vs_bowen': 'BCC vs Bowen',
+}
 
 LABEL_QUERIES = {
     'melanoma': 'diagnosis_3:"Melanoma, NOS"',
@@ -35,30 +112,303 @@ LABEL_QUERIES = {
 }
 
 
-def fetch_json(url: str, params=None):
+def with_retries(get, url: str, params=None, label: str = ''):
     last = None
     for i in range(1, RETRIES + 1):
         try:
-            r = requests.get(url, params=params, timeout=45)
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
+            return get(url, params=params, label=label)
+        except isic_http.FatalHTTPError as e:
+            raise RuntimeError(f'Failed request: {url} :: {e}') from e
+        except isic_http.RetryableError as e:
             last = e
-            time.sleep(min(2 ** i, 20))
+            if i < RETRIES:
+                METRICS.inc('http_retries_total', label=label, reason=str(e).split(':')[0])
+                delay = isic_http.backoff_delay(i, e.retry_after)
+                METRICS.inc('sleep_seconds_total', delay, kind='backoff', label=label)
+                time.sleep(delay)
     raise RuntimeError(f'Failed request: {url} :: {last}')
 
 
+def fetch_json(url: str, params=None, label: str = ''):
+    return with_retries(isic_http.get_json, url, params, label)
+
+
+def fetch_stream(url: str, params=None, label: str = ''):
+    """fetch_json, but the page is parsed while it downloads (an isic_stream.StreamedPage, or a dict from the cache)."""
+    def reopen():
+        return with_retries(isic_http.open_body, url, params, label)
+
+    def get(url, params=None, label=''):
+        return isic_http.stream_json(url, params=params, label=label, reopen=reopen, restarts=RETRIES)
+
+    return with_retries(get, url, params, label)
+
+
+def page_results(j) -> Iterable[dict]:
+    # streamed pages hand out their results once, as they arrive
+    return j.results if isinstance(j, StreamedPage) else j.get('results', [])
+
+
+def close_page(j):
+    if isinstance(j, StreamedPage):
+        j.close()
+
+
+def close_future(fut):
+    if not fut.cancelled() and fut.exception() is None:
+        close_page(fut.result())
+
+
+def iter_pages(url: str, params=None, label: str = '', stream: bool = False):
+    """Yield search pages along the cursor chain, one page of read-ahead when PREFETCH is on.
+
+    Close the generator (e.g. via contextlib.closing) to drop the read-ahead once a bucket is full.
+    With stream=True pages are StreamedPages: read them via page_results().
+    """
+    fetch = fetch_stream if stream else fetch_json
+    if not PREFETCH:
+        j = fetch(url, params, label)
+        while True:
+            METRICS.inc('pages_total', label=label)
+            yield j
+            nxt = j.get('next')
+            if not nxt:
+                return
+            j = fetch(nxt, None, label)
+
+    # the next cursor is only known once a page arrives, so one page ahead is the useful bound
+    pool = ThreadPoolExecutor(max_workers=1)
+    pending = deque([pool.submit(fetch, url, params, label)])
+    try:
+        while pending:
+            j = pending.popleft().result()
+            # a streamed page reads only as far as its 'next' field here
+            nxt = j.get('next')
+            if nxt:
+                pending.append(pool.submit(fetch, nxt, None, label))
+            METRICS.inc('pages_total', label=label)
+            yield j
+    finally:
+        for fut in pending:
+            if not fut.cancel():
+                # an opened read-ahead response holds a connection, also when it arrives after we stop
+                fut.add_done_callback(close_future)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def range_query(query: str, lo: int, hi: int) -> str:
+    return f'({query}) AND isic_id:[ISIC_{lo:07d} TO ISIC_{hi:07d}]'
+
+
+def partition_bounds(query: str, parts: int, label: str = '') -> List[list]:
+    """Up to `parts` contiguous, ascending [lo, hi] isic_id ranges that together cover ID_SPACE.
+
+    Ids are far from uniform, so the fullest range is halved (one count query per split)
+    until there are enough non-empty ranges; empty ones are folded into a neighbour.
+    Without result counts the id space is split evenly.
+    """
+    total = result_count(query, label)
+    if total is None:
+        width = -(-ID_SPACE // parts)
+        return [[i * width, min(ID_SPACE, (i + 1) * width) - 1] for i in range(parts)]
+    ranges = {(0, ID_SPACE - 1): total}
+    for _ in range(4 * parts):
+        if sum(1 for c in ranges.values() if c) >= parts:
+            break
+        (lo, hi), c = max(ranges.items(), key=lambda x: (x[1], -x[0][0]))
+        if hi <= lo or c <= PAGE_SIZE:
+            # a range that fits in one page gains nothing from another split
+            break
+        mid = (lo + hi) // 2
+        left = result_count(range_query(query, lo, mid), label)
+        if left is None:
+            break
+        del ranges[(lo, hi)]
+        ranges[(lo, mid)] = left
+        ranges[(mid + 1, hi)] = max(0, c - left)
+    merged = []
+    for (lo, hi), c in sorted(ranges.items()):
+        if merged and (c == 0 or merged[-1][2] == 0):
+            merged[-1][1] = hi
+            merged[-1][2] += c
+        else:
+            merged.append([lo, hi, c])
+    return [[lo, hi] for lo, hi, _ in merged]
+
+
+class PartitionWalk:
+    """Pages of a label's range partitions, yielded strictly in partition order.
+
+    Up to PARTITION_WINDOW partitions walk their cursor chains at once; pages of later
+    partitions wait in a bounded buffer until the merge reaches them, so the pages come
+    out exactly as one walk over partition 0, then 1, ... would produce them.
+    """
+
+    def __init__(self, label: str, query: str, parts: int, bounds: List[list], index: int = 0, next_url: str = None):
+        self.label = label
+        self.query = query
+        self.parts = parts
+        self.bounds = bounds
+        self.queries = [range_query(query, lo, hi) for lo, hi in bounds]
+        self.start = index
+        self.start_url = next_url
+        self.index = index
+        self._stop = threading.Event()
+        self._pool = None
+
+    def _offer(self, q: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _walk(self, i: int, q: queue.Queue):
+        if i == self.start and self.start_url:
+            pages = iter_pages(self.start_url, label=self.label)
+        else:
+            pages = iter_pages(SEARCH_URL, params={'query': self.queries[i], 'limit': PAGE_SIZE}, label=self.label)
+        try:
+            with closing(pages):
+                for j in pages:
+                    if not j.get('results'):
+                        break
+                    if not self._offer(q, ('page', j)) or self._stop.is_set():
+                        return
+                    if not j.get('next'):
+                        break
+        except BaseException as e:  # re-raised in the consuming thread
+            self._offer(q, ('error', e))
+            return
+        self._offer(q, ('done', None))
+
+    def __iter__(self):
+        todo = range(self.start, len(self.queries))
+        queues = {i: queue.Queue(maxsize=PARTITION_BUFFER) for i in todo}
+        # FIFO submission: the partition being consumed always has a worker
+        self._pool = ThreadPoolExecutor(max_workers=max(1, PARTITION_WINDOW), thread_name_prefix=f'part-{self.label}')
+        for i in todo:
+            self._pool.submit(self._walk, i, queues[i])
+        try:
+            for i in todo:
+                self.index = i
+                while True:
+                    kind, j = queues[i].get()
+                    if kind == 'done':
+                        break
+                    if kind == 'error':
+                        raise j
+                    yield j
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def cursor(self, j: dict) -> dict:
+        """Checkpoint position after consuming page j of the current partition."""
+        nxt = j.get('next')
+        return {
+            'query': self.query, 'parts': self.parts, 'bounds': self.bounds,
+            'index': self.index if nxt else self.index + 1, 'next': nxt,
+        }
+
+
+def ck_journal_path() -> Path:
+    # isic_checkpoint.json -> isic_checkpoint.journal (write-ahead deltas since the last snapshot)
+    return CK_PATH.with_name(CK_PATH.stem + '.journal')
+
+
 def save_ck(state: dict):
-    CK_PATH.write_text(json.dumps(state, ensure_ascii=False), encoding='utf-8')
+    """Full snapshot: atomic temp-file + rename, then the journal it covers is dropped."""
+    if OFFLINE:
+        return
+    t0 = time.perf_counter()
+    tmp = CK_PATH.with_name(CK_PATH.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        # '_'-prefixed keys are in-process bookkeeping, not checkpoint data
+        data = json.dumps({k: v for k, v in state.items() if not k.startswith('_')}, ensure_ascii=False, default=json_default)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, CK_PATH)
+    METRICS.observe('checkpoint_write_seconds', time.perf_counter() - t0, kind='snapshot')
+    METRICS.inc('checkpoint_bytes_total', len(data), kind='snapshot')
+    # a crash before this truncate is harmless: replay skips entries up to journal_seq
+    journal = ck_journal_path()
+    if journal.exists():
+        journal.unlink()
+    state['_journal_entries'] = 0
+
+
+def append_ck(state: dict, entry: dict):
+    """Append one per-page delta to the journal; compacts into a snapshot every CK_COMPACT_EVERY entries."""
+    if OFFLINE:
+        return
+    state['journal_seq'] = state.get('journal_seq', 0) + 1
+    entry['seq'] = state['journal_seq']
+    t0 = time.perf_counter()
+    line = json.dumps(entry, ensure_ascii=False, default=json_default) + '\n'
+    with open(ck_journal_path(), 'a', encoding='utf-8') as f:
+        f.write(line)
+    METRICS.observe('checkpoint_write_seconds', time.perf_counter() - t0, kind='journal')
+    METRICS.inc('checkpoint_bytes_total', len(line), kind='journal')
+    state['_journal_entries'] = state.get('_journal_entries', 0) + 1
+    if state['_journal_entries'] >= CK_COMPACT_EVERY:
+        save_ck(state)
 
 
 def load_ck():
-    if not CK_PATH.exists():
-        return None
-    try:
-        return json.loads(CK_PATH.read_text(encoding='utf-8'))
-    except Exception:
-        return None
+    state = None
+    if CK_PATH.exists():
+        try:
+            state = json.loads(CK_PATH.read_text(encoding='utf-8'))
+        except Exception:
+            state = None
+
+    journal = ck_journal_path()
+    if not journal.exists():
+        return state
+
+    state = state or {}
+    last = state.get('journal_seq', 0)
+    seen = {}
+
+    def extend_unique(key: str, label: str, cases: List[dict]):
+        # replay is idempotent: entries already folded into the snapshot are skipped by id
+        target = state.setdefault(key, {}).setdefault(label, [])
+        ids = seen.setdefault((key, label), set(x['id'] for x in target))
+        for x in cases:
+            if x['id'] not in ids:
+                ids.add(x['id'])
+                target.append(x)
+
+    with open(journal, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # torn write from a crash: only the tail can be incomplete
+                break
+            if entry.get('seq', 0) <= last:
+                continue
+            state.update(entry.get('cursors') or {})
+            for key, labels in (entry.get('resets') or {}).items():
+                for label in labels:
+                    state.setdefault(key, {})[label] = []
+                    seen.pop((key, label), None)
+            for label, cases in (entry.get('cases') or {}).items():
+                extend_unique('buckets', label, cases)
+            pool_key = entry.get('pool_key', 'clinical')
+            for label, cases in (entry.get('pools') or {}).items():
+                extend_unique(pool_key, label, cases)
+            last = entry['seq']
+    state['journal_seq'] = last
+    return state
 
 
 def is_dermoscopic(meta: dict) -> bool:
@@ -72,95 +422,284 @@ def is_histopathology(clinical: dict) -> bool:
     return 'histopath' in conf
 
 
-def add_case(bucket: List[dict], seen_image_ids: set, seen_lesion_ids: set, label: str, r: dict, allow_clinical_fallback: bool = False):
+def accept_case(bucket: List[dict], seen_image_ids: set, seen_lesion_ids: set, case: dict) -> str:
+    if case['id'] in seen_image_ids:
+        return 'duplicate_image'
+    lesion_id = case.get('lesionId', '')
+    # prevent near-duplicate follow-up photos of same lesion
+    if lesion_id and lesion_id in seen_lesion_ids:
+        return 'lesion_dedup'
+    bucket.append(case)
+    seen_image_ids.add(case['id'])
+    if lesion_id:
+        seen_lesion_ids.add(lesion_id)
+    return 'accepted'
+
+
+def add_case(bucket: List[dict], seen_image_ids: set, seen_lesion_ids: set, label: str, r: dict, allow_clinical_fallback: bool = False, clinical_pool: List[dict] = None):
     isic_id = r.get('isic_id', '')
-    if not isic_id or isic_id in seen_image_ids:
-        return
+    if not isic_id:
+        return METRICS.inc('add_case_outcomes_total', label=label, outcome='missing_id')
+    if isic_id in seen_image_ids:
+        return METRICS.inc('add_case_outcomes_total', label=label, outcome='duplicate_image')
 
     meta = r.get('metadata') or {}
     clinical = meta.get('clinical') or {}
     if not is_dermoscopic(meta):
-        return
+        return METRICS.inc('add_case_outcomes_total', label=label, outcome='is_dermoscopic')
+
+    img = ((r.get('files') or {}).get('full') or {}).get('url', '')
+    if not img:
+        return METRICS.inc('add_case_outcomes_total', label=label, outcome='missing_url')
+
+    case = Case(isic_id, str(clinical.get('lesion_id', '') or ''), img, label, 'histopathology')
 
     # Prefer histopathology; optionally allow clinical when needed
-    is_histo = is_histopathology(clinical)
-    if not is_histo and not allow_clinical_fallback:
-        return
+    if not is_histopathology(clinical):
+        case['source'] = 'clinical diagnosis'
+        if not allow_clinical_fallback:
+            # remember it for pass 2 so the fallback needs no extra requests
+            if clinical_pool is not None:
+                clinical_pool.append(case)
+                METRICS.inc('clinical_pooled_total', label=label)
+            return METRICS.inc('add_case_outcomes_total', label=label, outcome='is_histopathology')
 
-    lesion_id = str(clinical.get('lesion_id', '') or '')
-    # prevent near-duplicate follow-up photos of same lesion
-    if lesion_id and lesion_id in seen_lesion_ids:
+    METRICS.inc('add_case_outcomes_total', label=label, outcome=accept_case(bucket, seen_image_ids, seen_lesion_ids, case))
+
+
+def checkpoint_page(state: dict, cursors: dict, buckets: Dict[str, List[dict]], pools: Dict[str, List[dict]], pool_key: str = 'clinical'):
+    # buckets and pools only grow during a harvest, so the delta is whatever the state has not seen yet
+    with CK_LOCK:
+        entry = {'cursors': cursors, 'cases': {}, 'pools': {}, 'pool_key': pool_key}
+        state.update(cursors)
+        for label, bucket in buckets.items():
+            if isinstance(bucket, isic_store.StoreBucket):
+                # the store is the bucket's checkpoint: one batched insert per page
+                bucket.flush()
+                continue
+            have = state.setdefault('buckets', {}).setdefault(label, [])
+            if len(bucket) > len(have):
+                entry['cases'][label] = bucket[len(have):]
+                have.extend(entry['cases'][label])
+        for label, pool in pools.items():
+            if pool is None:
+                continue
+            have = state.setdefault(pool_key, {}).setdefault(label, [])
+            if len(pool) > len(have):
+                entry['pools'][label] = pool[len(have):]
+                have.extend(entry['pools'][label])
+        append_ck(state, entry)
+
+
+@contextmanager
+def archive_page(label: str):
+    """Archive writer for the page being read (isic_store.ArchivePage), or None when not archiving."""
+    if ARCHIVE is None or OFFLINE:
+        yield None
         return
+    page = ARCHIVE.page(label)
+    try:
+        yield page
+    except BaseException:
+        page.abort()
+        raise
+    page.close()
 
-    img = ((r.get('files') or {}).get('full') or {}).get('url', '')
-    if not img:
+
+def open_bucket(state: dict, label: str):
+    """Bucket plus its seen image/lesion ids; backed by STORE when configured. Call under CK_LOCK."""
+    if STORE is not None:
+        bucket = STORE.bucket(label)
+        return bucket, bucket.image_ids, bucket.lesion_ids
+    # work on a private copy; the shared state only sees deltas via checkpoint_page
+    bucket = [Case.from_dict(x) for x in state.get('buckets', {}).get(label, [])]
+    seen_image_ids = IdSet(x['id'] for x in bucket)
+    seen_lesion_ids = IdSet(x.lesionId for x in bucket if x.lesionId)
+    return bucket, seen_image_ids, seen_lesion_ids
+
+
+def finish_bucket(bucket):
+    if isinstance(bucket, isic_store.StoreBucket):
+        bucket.flush()
+    return bucket
+
+
+def label_diagnoses(labels=None) -> Dict[str, str]:
+    # 'diagnosis_3:"Nevus"' -> {'nevus': 'Nevus'}
+    out = {}
+    for label, query in LABEL_QUERIES.items():
+        if labels is not None and label not in labels:
+            continue
+        m = re.fullmatch(r'diagnosis_3:"([^"]+)"', query.strip())
+        if m:
+            out[label] = m.group(1)
+    return out
+
+
+def resume_pool(state: dict, label: str, next_url, pool_key: str = 'clinical'):
+    # the clinical pool is only complete if it was recorded from page 1 onwards of
+    # the same walk; checkpoints from before it existed resume mid-query without one
+    pools = state.get(pool_key, {})
+    if not next_url:
+        # a fresh walk from page 1 records its pool from scratch
+        if pools.get(label):
+            pools[label] = []
+            append_ck(state, {'cursors': {}, 'resets': {pool_key: [label]}})
+        return []
+    if label in pools:
+        return [Case.from_dict(x) for x in pools[label]]
+    return None
+
+
+def fill_from_clinical(label: str, query: str, bucket: List[dict], seen_image_ids: set, seen_lesion_ids: set, clinical_pool, target: int):
+    if len(bucket) >= target:
+        return
+    if clinical_pool is not None:
+        # pass 1 has seen every page of the query; replay its clinical candidates in page order
+        for case in clinical_pool:
+            METRICS.inc('clinical_fallback_total', label=label, outcome=accept_case(bucket, seen_image_ids, seen_lesion_ids, case))
+            if len(bucket) >= target:
+                break
         return
 
-    bucket.append({
-        'id': isic_id,
-        'lesionId': lesion_id,
-        'imageUrl': img,
-        'diagnosis': label,
-        'source': 'histopathology' if is_histo else 'clinical diagnosis'
-    })
-    seen_image_ids.add(isic_id)
-    if lesion_id:
-        seen_lesion_ids.add(lesion_id)
+    # restart query from first page to include clinically diagnosed unique lesions
+    with closing(iter_pages(SEARCH_URL, params={'query': query, 'limit': PAGE_SIZE}, label=label, stream=STREAM)) as pages:
+        for j in pages:
+            n = 0
+            with archive_page(label) as archived:
+                for r in page_results(j):
+                    n += 1
+                    if archived is not None:
+                        archived.add(r)
+                    if len(bucket) < target:
+                        add_case(bucket, seen_image_ids, seen_lesion_ids, label, r, allow_clinical_fallback=True)
+                    elif archived is None:
+                        break
+            close_page(j)
+            if not n or len(bucket) >= target:
+                break
 
 
 def harvest_label(label: str, query: str, state: dict, target: int) -> List[dict]:
-    bucket = state.get('buckets', {}).get(label, [])
-    seen_image_ids = set(x['id'] for x in bucket)
-    seen_lesion_ids = set(str(x.get('lesionId', '') or '') for x in bucket if x.get('lesionId'))
-
-    next_key = f'next_{label}'
-    next_url = state.get(next_key)
+    with CK_LOCK:
+        bucket, seen_image_ids, seen_lesion_ids = open_bucket(state, label)
+        if len(bucket) >= target:
+            # already full: no request, and the stored cursor and pool stay as they are
+            return bucket
+        if PARTITIONS > 1 and not OFFLINE:
+            # a stored position only applies to the same query split the same way
+            pos = state.get(f'partition_{label}') or {}
+            if pos.get('query') != query or pos.get('parts') != PARTITIONS:
+                pos = {}
+            next_url = None
+            clinical_pool = resume_pool(state, label, pos.get('next') or pos.get('index'), 'partition_clinical')
+        else:
+            pos = None
+            next_url = state.get(f'next_{label}')
+            clinical_pool = resume_pool(state, label, next_url)
 
-    if next_url:
-        j = fetch_json(next_url)
+    if pos is not None:
+        # resume on the stored split: the same ranges keep the merged order identical
+        bounds = pos.get('bounds') or partition_bounds(query, PARTITIONS, label)
+        pages = PartitionWalk(label, query, PARTITIONS, bounds, pos.get('index', 0), pos.get('next'))
+    elif OFFLINE:
+        pages = ARCHIVE.pages([label], page_size=PAGE_SIZE)
+    elif next_url:
+        pages = iter_pages(next_url, label=label, stream=STREAM)
     else:
-        j = fetch_json(SEARCH_URL, params={'query': query, 'limit': 200})
+        pages = iter_pages(SEARCH_URL, params={'query': query, 'limit': PAGE_SIZE}, label=label, stream=STREAM)
 
     # Pass 1: histopathology only
-    while len(bucket) < target:
-        results = j.get('results', [])
-        if not results:
-            break
+    with closing(pages):
+        for j in pages:
+            # one pass over the page: the whole page is archived, add_case stops at the target
+            n = 0
+            with archive_page(label) as archived:
+                for r in page_results(j):
+                    n += 1
+                    if archived is not None:
+                        archived.add(r)
+                    if len(bucket) < target:
+                        add_case(bucket, seen_image_ids, seen_lesion_ids, label, r, allow_clinical_fallback=False, clinical_pool=clinical_pool)
+                    elif archived is None:
+                        break
+            close_page(j)
+            if not n:
+                break
+
+            if pos is not None:
+                checkpoint_page(state, {f'partition_{label}': pages.cursor(j)}, {label: bucket}, {label: clinical_pool}, 'partition_clinical')
+            else:
+                checkpoint_page(state, {f'next_{label}': j.get('next')}, {label: bucket}, {label: clinical_pool})
 
-        for r in results:
-            add_case(bucket, seen_image_ids, seen_lesion_ids, label, r, allow_clinical_fallback=False)
             if len(bucket) >= target:
                 break
 
-        next_url = j.get('next')
-        state[next_key] = next_url
-        state.setdefault('buckets', {})[label] = bucket
-        save_ck(state)
+    # Pass 2 (fallback): allow clinical diagnosis if still too few
+    fill_from_clinical(label, query, bucket, seen_image_ids, seen_lesion_ids, clinical_pool, target)
+    # the fallback cases are not in any page checkpoint; record them before a later label can fail
+    checkpoint_page(state, {}, {label: bucket}, {})
 
-        if not next_url:
-            break
-        j = fetch_json(next_url)
-        time.sleep(0.08)
+    return finish_bucket(bucket)
 
-    # Pass 2 (fallback): allow clinical diagnosis if still too few
-    if len(bucket) < target:
-        # restart query from first page to include clinically diagnosed unique lesions
-        j = fetch_json(SEARCH_URL, params={'query': query, 'limit': 200})
-        while len(bucket) < target:
-            results = j.get('results', [])
-            if not results:
+
+def harvest_multiplexed(state: dict, target: int, labels=None) -> Dict[str, List[dict]]:
+    """Walk one OR query for all unfilled labels (or the given subset) and route results by diagnosis_3."""
+    diagnoses = label_diagnoses(labels)
+    with CK_LOCK:
+        opened = {k: open_bucket(state, k) for k in diagnoses}
+    buckets = {k: v[0] for k, v in opened.items()}
+    seen = {k: (v[1], v[2]) for k, v in opened.items()}
+    todo = [k for k in diagnoses if len(buckets[k]) < target]
+    route = {diagnoses[k]: k for k in todo}
+    if not todo:
+        return buckets
+
+    query = ' OR '.join(f'({LABEL_QUERIES[k]})' for k in todo)
+    with CK_LOCK:
+        # a stored cursor belongs to the query it was issued for
+        next_url = state.get('multiplex_next') if state.get('multiplex_query') == query else None
+        pools = {k: resume_pool(state, k, next_url, 'multiplex_clinical') for k in todo}
+
+    if OFFLINE:
+        pages = ARCHIVE.pages(todo, page_size=PAGE_SIZE)
+    elif next_url:
+        pages = iter_pages(next_url, label='multiplex', stream=STREAM)
+    else:
+        pages = iter_pages(SEARCH_URL, params={'query': query, 'limit': PAGE_SIZE}, label='multiplex', stream=STREAM)
+
+    # Pass 1: histopathology only, until every bucket is full
+    with closing(pages):
+        for j in pages:
+            n = 0
+            with ExitStack() as stack:
+                archived = {k: stack.enter_context(archive_page(k)) for k in todo}
+                for r in page_results(j):
+                    n += 1
+                    clinical = (r.get('metadata') or {}).get('clinical') or {}
+                    label = route.get(clinical.get('diagnosis_3'))
+                    if label is None:
+                        continue
+                    if archived[label] is not None:
+                        archived[label].add(r)
+                    if len(buckets[label]) < target:
+                        add_case(buckets[label], seen[label][0], seen[label][1], label, r, allow_clinical_fallback=False, clinical_pool=pools[label])
+            close_page(j)
+            if not n:
                 break
-            for r in results:
-                add_case(bucket, seen_image_ids, seen_lesion_ids, label, r, allow_clinical_fallback=True)
-                if len(bucket) >= target:
-                    break
-            nxt = j.get('next')
-            if not nxt:
+
+            next_url = j.get('next')
+            checkpoint_page(state, {'multiplex_query': query, 'multiplex_next': next_url}, {k: buckets[k] for k in todo}, pools, 'multiplex_clinical')
+
+            if all(len(buckets[k]) >= target for k in todo):
                 break
-            j = fetch_json(nxt)
-            time.sleep(0.05)
 
-    return bucket
+    # Pass 2 (fallback): per label, from the recorded clinical pools
+    for k in todo:
+        fill_from_clinical(k, LABEL_QUERIES[k], buckets[k], seen[k][0], seen[k][1], pools[k], target)
+    checkpoint_page(state, {}, {k: buckets[k] for k in todo}, {})
+
+    return {k: finish_bucket(b) for k, b in buckets.items()}
 
 
 def build_sets(a: List[dict], b: List[dict], nsets=3, preferred_per_class=5, fallback_per_class=3):
@@ -186,32 +725,706 @@ def build_sets(a: List[dict], b: List[dict], nsets=3, preferred_per_class=5, fal
     return []
 
 
-def main():
+@contextmanager
+def stage(name: str):
+    with METRICS.timer('stage_seconds', stage=name):
+        with (PROFILER.stage(name) if PROFILER is not None else nullcontext()):
+            yield
+
+
+def set_candidates(buckets: dict, label: str, nsets: int = 3, per_class: int = 5) -> List[dict]:
+    # build_sets only ever uses the lowest ids; with a store, fetch just those from the index
+    if STORE is not None:
+        return STORE.first_by_id(label, nsets * per_class)
+    return buckets[label]
+
+
+def mirror_images(modules: dict) -> dict:
+    """Copy of `modules` whose imageUrl points at the local mirror; the remote URL moves to sourceUrl.
+
+    Cases in the buckets are not touched, so the checkpoint and store keep the remote URLs.
+    Images that could not be mirrored keep their remote imageUrl.
+    """
+    mirror = isic_mirror.ImageMirror(MIRROR_DIR, MIRROR_URL_PREFIX, workers=MIRROR_WORKERS, retries=RETRIES, offline=OFFLINE)
+    def remote(case):
+        # cases kept from an earlier output already point at the mirror
+        return case.get('sourceUrl') or case.get('imageUrl')
+
+    entries = mirror.sync(remote(c) for sets in modules.values() for s in sets for c in s)
+    out = {}
+    for name, sets in modules.items():
+        out[name] = []
+        for s in sets:
+            copies = []
+            for case in s:
+                case = Case.from_dict(case.to_dict() if isinstance(case, Case) else case)
+                src = remote(case)
+                entry = entries.get(src)
+                case['imageUrl'] = mirror.local_url(entry) if entry is not None else src
+                case['sourceUrl'] = src
+                copies.append(case)
+            out[name].append(copies)
+    total = len({remote(c) for sets in modules.values() for s in sets for c in s})
+    print(f'mirror: {len(entries)}/{total} images local in {MIRROR_DIR}')
+    return out
+
+
+def add_derivatives(modules: dict) -> dict:
+    """Attach case['images'] = {use: [{width, height, avif?, webp}]} for every mirrored case."""
+    mirror = isic_mirror.ImageMirror(MIRROR_DIR, MIRROR_URL_PREFIX, offline=True)
+    index = mirror.index['images']
+    cases = [c for sets in modules.values() for s in sets for c in s]
+    originals = {}
+    for case in cases:
+        entry = index.get(case.get('sourceUrl'))
+        if entry is not None and mirror.has_object(entry):
+            originals[entry['sha256']] = mirror.object_path(entry)
+    store = isic_derivatives.DerivativeStore(MIRROR_DIR, DERIVATIVE_WORKERS)
+    derived = store.build(originals)
+
+    before = after = 0
+    for case in cases:
+        entry = index.get(case.get('sourceUrl'))
+        variants = derived.get(entry['sha256']) if entry is not None else None
+        if not variants:
+            continue
+        images = {}
+        for v in variants:
+            images.setdefault(v['use'], []).append(
+                dict({'width': v['width'], 'height': v['height']}, **{fmt: f'{mirror.url_prefix}/{v[fmt]}' for fmt in store.formats}))
+        case['images'] = images
+        # what a player downloads per question: the original vs the largest quiz size in the first format
+        before += entry['size']
+        after += max((v for v in variants if v['use'] == 'quiz'), key=lambda v: v['width'])['bytes'] // len(store.formats)
+    print(f'derivatives: {len(derived)}/{len(originals)} images ({", ".join(store.formats)}), '
+          f'quiz image bytes {before / 1e6:.1f} MB -> ~{after / 1e6:.1f} MB')
+    return modules
+
+
+def pack_images(modules: dict) -> dict:
+    """Put the mirrored images and derivatives of `modules` into PACK_PATH and point the cases at PACK_URL_PREFIX.
+
+    Pack keys are <isic_id>/original.<ext> and <isic_id>/<width>w.<fmt>. URLs that already point
+    into the pack (modules kept from an earlier output) keep their entries.
+    """
+    mirror_prefix = MIRROR_URL_PREFIX.rstrip('/') + '/'
+    pack_prefix = PACK_URL_PREFIX.rstrip('/') + '/'
+    items, keep = {}, set()
+
+    def packed(case_id: str, name: str, url: str) -> str:
+        if url and url.startswith(pack_prefix):
+            keep.add(url[len(pack_prefix):])
+        elif url and url.startswith(mirror_prefix):
+            key = f'{case_id}/{name}'
+            items[key] = MIRROR_DIR / url[len(mirror_prefix):]
+            return pack_prefix + key
+        return url
+
+    for sets in modules.values():
+        for s in sets:
+            for case in s:
+                url = case['imageUrl']
+                case['imageUrl'] = packed(case['id'], 'original' + Path(url).suffix, url)
+                for variants in (case.get('images') or {}).values():
+                    for v in variants:
+                        for fmt in isic_derivatives.FORMATS:
+                            if fmt in v:
+                                v[fmt] = packed(case['id'], f"{v['width']}w.{fmt}", v[fmt])
+    stats = isic_pack.export(PACK_PATH, sorted(items.items()), keep)
+    print(f"pack: {stats['keys']} keys, {stats['bytes_appended'] / 1e6:.1f} MB appended, "
+          f"{stats['pack_bytes'] / 1e6:.1f} MB in {PACK_PATH}")
+    return modules
+
+
+def iter_by_id(buckets: dict, label: str, batch: int):
+    """A label's cases in id order (the order build_sets takes them in)."""
+    if STORE is None:
+        yield from sorted(buckets[label], key=lambda x: x['id'])
+        return
+    n = 0
+    while True:
+        page = STORE.first_by_id(label, n + batch)[n:]
+        if not page:
+            return
+        yield from page
+        n += len(page)
+
+
+def drop_near_duplicates(buckets: dict, nsets: int = 3, per_class: int = 5) -> Dict[str, List[dict]]:
+    """Per label, the first nsets * per_class cases by id whose image is not a near-duplicate of one accepted earlier.
+
+    Labels are checked in LABEL_QUERIES order against the images of every label accepted so far,
+    always for all modules, so partial rebuilds reject the same cases as full ones.
+    Images that cannot be mirrored or decoded are kept: there is nothing to compare.
+    """
+    need = nsets * per_class
+    mirror = isic_mirror.ImageMirror(MIRROR_DIR, MIRROR_URL_PREFIX, workers=MIRROR_WORKERS, retries=RETRIES, offline=OFFLINE)
+    cache = isic_phash.HashCache(MIRROR_DIR)
+    seen = isic_phash.NearDuplicates()
+    wanted = {label for pair in MODULES.values() for label in pair}
+    out = {}
+    for label in [k for k in LABEL_QUERIES if k in wanted]:
+        accepted = []
+        cases = iter_by_id(buckets, label, need)
+        while len(accepted) < need:
+            batch = list(islice(cases, need - len(accepted)))
+            if not batch:
+                break
+            entries = mirror.sync(c['imageUrl'] for c in batch)
+            hashes = cache.get_many({e['sha256']: mirror.object_path(e) for e in entries.values()})
+            for case in batch:
+                entry = entries.get(case['imageUrl'])
+                h = hashes.get(entry['sha256']) if entry is not None else None
+                if h is not None:
+                    dup = seen.check(case['id'], h)
+                    if dup is not None:
+                        METRICS.inc('near_duplicates_total', label=label)
+                        print(f'near-dup: {label} {case["id"]} looks like {dup[0]} (pHash distance {dup[1]})')
+                        continue
+                    seen.add(case['id'], h)
+                accepted.append(case)
+        out[label] = accepted
+    cache.save()
+    return out
+
+
+def near_dup_shortfall(buckets: dict, candidates: dict, nsets: int = 3, per_class: int = 5) -> Dict[str, int]:
+    """Per label, how many of its set candidates drop_near_duplicates rejected without a replacement."""
+    need = nsets * per_class
+    short = {}
+    for label, accepted in candidates.items():
+        missing = min(need, len(buckets[label])) - len(accepted)
+        if missing > 0:
+            short[label] = missing
+    return short
+
+
+def refill_near_duplicates(state: dict, buckets: dict, candidates: dict, labels: List[str]) -> dict:
+    """Harvest past the target for labels that lost set candidates to near-duplicates, then check again.
+
+    Each round asks for as many extra cases as were rejected; the walk resumes from the stored
+    cursor, so a label without rejections keeps exactly the cases it had.
+    """
+    for _ in range(NEAR_DUP_ROUNDS):
+        short = {k: n for k, n in near_dup_shortfall(buckets, candidates).items() if k in labels}
+        if not short:
+            break
+        grown = False
+        with stage('near_dup_refill'):
+            for label, missing in short.items():
+                before = len(buckets[label])
+                result = harvest_label(label, LABEL_QUERIES[label], state, before + missing)
+                with CK_LOCK:
+                    buckets[label] = result
+                print(f'near-dup: {label}: {len(result) - before} more case(s) harvested to replace {missing} near-duplicate(s)')
+                grown = grown or len(result) > before
+        if not grown:
+            # the queries are exhausted
+            break
+        with stage('near_dup'):
+            candidates = drop_near_duplicates(buckets)
+    return candidates
+
+
+def load_history(path: Path) -> tuple:
+    """(acceptance rate per label, mean request latency) from the harvest history (or a metrics report)."""
+    try:
+        report = json.loads(Path(path).read_text(encoding='utf-8'))
+    except (OSError, TypeError, ValueError):
+        return {}, None
+    rates = {}
+    for label, f in (report.get('filters') or {}).items():
+        evaluated = f.get(FILTER_ORDER[0], {}).get('evaluated') or 0
+        if evaluated:
+            rates[label] = f.get('accepted', 0) / evaluated
+    n = total = 0
+    for h in report.get('histograms') or []:
+        if h.get('name') == 'http_request_seconds':
+            n += h.get('count', 0)
+            total += h.get('sum', 0.0)
+    return rates, (total / n if n else None)
+
+
+def update_history(path: Path, report: dict):
+    """Fold a run's metrics report into the harvest history that --plan reads.
+
+    Per label the filter counts of the last run that evaluated records for it are kept, and
+    the request latency of the last run that made requests; build-only runs change nothing.
+    """
+    try:
+        history = json.loads(Path(path).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        history = {}
+    filters = dict(history.get('filters') or {})
+    new = {label: f for label, f in (report.get('filters') or {}).items() if f.get(FILTER_ORDER[0], {}).get('evaluated')}
+    latency = [h for h in report.get('histograms') or [] if h.get('name') == 'http_request_seconds' and h.get('count')]
+    if not new and not latency:
+        return
+    filters.update(new)
+    history = {
+        'generated_at': report.get('generated_at'),
+        'filters': filters,
+        'histograms': latency or history.get('histograms') or [],
+    }
+    tmp = Path(path).with_name(Path(path).name + '.tmp')
+    tmp.write_text(json.dumps(history, ensure_ascii=False, indent=2), encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def result_count(query: str, label: str):
+    # the search endpoint reports the total match count on every page; a one-result page is enough
+    try:
+        return fetch_json(SEARCH_URL, params={'query': query, 'limit': 1}, label=label).get('count')
+    except RuntimeError:
+        return None
+
+
+def plan_harvest(state: dict, labels: List[str], target: int, query_counts: bool = True) -> dict:
+    """Estimate pages, requests and duration per label without harvesting anything."""
+    rates, latency = load_history(HISTORY_PATH) if HISTORY_PATH is not None else ({}, None)
+    rows = []
+    for label in labels:
+        have = len(state['buckets'].get(label, []))
+        if STORE is not None:
+            # checkpoint buckets not yet migrated count as well
+            have = max(have, STORE.count(label))
+        row = {'label': label, 'have': have, 'need': max(0, target - have), 'resume': bool(state.get(f'next_{label}'))}
+        if row['need'] == 0:
+            row.update(status='full', pages=0)
+            rows.append(row)
+            continue
+        count = result_count(LABEL_QUERIES[label], label) if query_counts else None
+        max_pages = -(-count // PAGE_SIZE) if count is not None else None
+        rate = rates.get(label)
+        if rate:
+            pages = -(-int(row['need'] / rate) // PAGE_SIZE) or 1
+            if max_pages is not None:
+                pages = min(pages, max_pages)
+        else:
+            # no history for this label: assume the whole query has to be walked
+            pages = max_pages
+        row.update(status='harvest', count=count, acceptance=round(rate, 4) if rate else None, pages=pages)
+        rows.append(row)
+
+    requests = sum(r['pages'] or 0 for r in rows)
+    longest = max((r['pages'] or 0 for r in rows), default=0)
+    workers = max(1, min(HARVEST_WORKERS, sum(1 for r in rows if r['pages'])))
+    # the shared rate limit and each label's sequential cursor chain both bound the run
+    seconds = requests / REQUESTS_PER_SECOND
+    if latency is not None:
+        seconds = max(seconds, longest * latency, requests * latency / workers)
+    return {
+        'labels': rows,
+        'requests': requests,
+        'unknown': [r['label'] for r in rows if r['pages'] is None],
+        'mean_latency_s': round(latency, 3) if latency is not None else None,
+        'estimated_seconds': round(seconds, 1),
+    }
+
+
+def print_plan(plan: dict):
+    print(f"{'label':<24}{'have':>6}{'need':>6}{'count':>9}{'accept':>9}{'pages':>7}  status")
+    for r in plan['labels']:
+        count = r.get('count')
+        rate = r.get('acceptance')
+        pages = r['pages']
+        status = r['status'] + (' (resume)' if r['resume'] and r['status'] != 'full' else '')
+        print(f"{r['label']:<24}{r['have']:>6}{r['need']:>6}"
+              f"{'?' if count is None else count:>9}{'?' if rate is None else f'{rate:.1%}':>9}"
+              f"{'?' if pages is None else pages:>7}  {status}")
+    latency = plan['mean_latency_s']
+    print(f"\n~{plan['requests']} requests, ~{plan['estimated_seconds']} s at {REQUESTS_PER_SECOND:g} req/s"
+          + (f", {latency} s mean latency" if latency is not None else ' (no latency history)'))
+    if plan['unknown']:
+        print(f"no count or acceptance history for: {', '.join(plan['unknown'])}")
+
+
+def csv_list(value: str) -> List[str]:
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description='Stichting HUID - ISIC quizset builder')
+    ap.add_argument('--out-dir', type=Path, metavar='DIR',
+                    help='data directory for output, checkpoint, cache, archive and metrics (default: %s)' % BASE)
+    ap.add_argument('--labels', type=csv_list, metavar='A,B', help='harvest only these labels (default: all)')
+    ap.add_argument('--modules', type=csv_list, metavar='A,B',
+                    help='build only these modules; implies their labels. Other modules are kept from the existing output')
+    ap.add_argument('--target', type=int, default=TARGET_PER_LABEL, help='cases per label (default: %(default)s)')
+    ap.add_argument('--workers', type=int, default=HARVEST_WORKERS, help='labels harvested in parallel (default: %(default)s)')
+    ap.add_argument('--rps', type=float, default=REQUESTS_PER_SECOND, help='request rate shared by all workers (default: %(default)s)')
+    ap.add_argument('--retries', type=int, default=RETRIES, help='attempts per request (default: %(default)s)')
+    ap.add_argument('--page-size', type=int, default=PAGE_SIZE, help='results per search page (default: %(default)s)')
+    ap.add_argument('--mode', choices=('per_label', 'multiplex'), default=HARVEST_MODE)
+    ap.add_argument('--partitions', type=int, default=PARTITIONS,
+                    help='per-label walks: split each query into N isic_id ranges walked concurrently (default: %(default)s)')
+    ap.add_argument('--stream', action='store_true', default=STREAM,
+                    help='parse search pages while they download; partitioned walks stay buffered')
+    cache = ap.add_mutually_exclusive_group()
+    cache.add_argument('--cache-dir', type=Path, metavar='DIR', help='HTTP response cache (default: <out-dir>/http_cache)')
+    cache.add_argument('--no-cache', action='store_true', help='disable the HTTP response cache')
+    ap.add_argument('--store', type=Path, metavar='PATH',
+                    help='keep buckets in this SQLite candidate store; the checkpoint remembers it for later runs')
+    run = ap.add_mutually_exclusive_group()
+    run.add_argument('--offline', action='store_true', help='rebuild from the raw archive only: no network, no checkpoint')
+    run.add_argument('--only-build', action='store_true', help='skip harvesting; build sets from the checkpoint or store')
+    run.add_argument('--plan', action='store_true',
+                     help='dry run: estimate pages, requests and duration per label from the checkpoint, result counts '
+                          'and the harvest history; harvests nothing')
+    ap.add_argument('--mirror', nargs='?', const='', metavar='DIR',
+                    help='download the quiz images into DIR (default: <out-dir>/images) and point imageUrl there')
+    ap.add_argument('--mirror-prefix', default=MIRROR_URL_PREFIX, metavar='URL',
+                    help='URL under which the front-end serves the mirror directory (default: %(default)s)')
+    ap.add_argument('--derivatives', action='store_true', default=DERIVATIVES,
+                    help='make WebP/AVIF thumbnails, previews and quiz sizes of the mirrored images (needs Pillow; implies --mirror)')
+    ap.add_argument('--pack', nargs='?', const='', metavar='PATH',
+                    help='pack the mirrored images and derivatives into one file (default: <out-dir>/images.pack) '
+                         'and point the cases at --pack-prefix; serve it with scripts/isic_pack.py (implies --mirror)')
+    ap.add_argument('--pack-prefix', default=PACK_URL_PREFIX, metavar='URL',
+                    help='URL under which isic_pack.py serves the pack (default: %(default)s)')
+    ap.add_argument('--near-dup', action='store_true', default=NEAR_DUP,
+                    help='skip set candidates whose image is a near-duplicate (pHash/dHash) of an earlier one, '
+                         'across all labels (needs NumPy and Pillow; implies --mirror)')
+    ap.add_argument('--output-format', type=int, choices=(1, 2), default=OUTPUT_FORMAT,
+                    help='2: one cases table, sets list case ids; 1: cases repeated inside every set (default: %(default)s)')
+    ap.add_argument('--no-quiz-files', action='store_true',
+                    help='do not write <out-dir>/quiz (manifest.json + one file per set, loaded lazily by app.js)')
+    ap.add_argument('--profile', nargs='?', const='', metavar='DIR',
+                    help='profile each stage (cProfile, collapsed stacks, tracemalloc) into DIR (default: <out-dir>/profile)')
+    args = ap.parse_args(argv)
+
+    unknown = [k for k in args.labels or [] if k not in LABEL_QUERIES]
+    if unknown:
+        ap.error(f'unknown label(s): {", ".join(unknown)}; choose from {", ".join(LABEL_QUERIES)}')
+    unknown = [k for k in args.modules or [] if k not in MODULES]
+    if unknown:
+        ap.error(f'unknown module(s): {", ".join(unknown)}; choose from {", ".join(MODULES)}')
+    for name in ('target', 'workers', 'retries', 'page_size', 'partitions'):
+        if getattr(args, name) < 1:
+            ap.error(f'--{name.replace("_", "-")} must be at least 1')
+    if args.rps <= 0:
+        ap.error('--rps must be positive')
+    if args.derivatives and not (isic_derivatives.available() and isic_derivatives.supported_formats()):
+        ap.error('--derivatives needs Pillow with WebP support (pip install Pillow)')
+    if args.near_dup and not isic_phash.available():
+        ap.error('--near-dup needs NumPy and Pillow (pip install numpy Pillow)')
+    return args
+
+
+def configure(args):
+    """Apply command-line options to the module settings."""
+    global BASE, OUT_PATH, CK_PATH, CACHE_DIR, ARCHIVE_DIR, METRICS_PATH, HISTORY_PATH, STORE_PATH, OFFLINE, MIRROR_DIR, MIRROR_URL_PREFIX, DERIVATIVES, NEAR_DUP
+    global PACK_PATH, PACK_URL_PREFIX, OUTPUT_FORMAT, QUIZ_DIR
+    global TARGET_PER_LABEL, HARVEST_WORKERS, REQUESTS_PER_SECOND, RETRIES, PAGE_SIZE, HARVEST_MODE, PARTITIONS, STREAM
+    if args.out_dir is not None:
+        BASE = args.out_dir
+        OUT_PATH = BASE / OUT_PATH.name
+        QUIZ_DIR = BASE / 'quiz' if QUIZ_DIR is not None else None
+        CK_PATH = BASE / CK_PATH.name
+        CACHE_DIR = BASE / 'http_cache' if CACHE_DIR is not None else None
+        ARCHIVE_DIR = BASE / 'raw_archive' if ARCHIVE_DIR is not None else None
+        METRICS_PATH = BASE / METRICS_PATH.name if METRICS_PATH is not None else None
+        HISTORY_PATH = BASE / HISTORY_PATH.name if HISTORY_PATH is not None else None
+    if args.cache_dir is not None:
+        CACHE_DIR = args.cache_dir
+    elif args.no_cache:
+        CACHE_DIR = None
+    if args.store is not None:
+        STORE_PATH = args.store
+    if args.offline:
+        OFFLINE = True
+    # no type=Path on these: argparse would turn the bare-flag const '' into Path('.')
+    if args.profile is not None:
+        args.profile = Path(args.profile) if args.profile else BASE / 'profile'
+    if args.mirror is not None:
+        MIRROR_DIR = Path(args.mirror) if args.mirror else BASE / 'images'
+    MIRROR_URL_PREFIX = args.mirror_prefix
+    DERIVATIVES = args.derivatives
+    NEAR_DUP = args.near_dup
+    if args.pack is not None:
+        PACK_PATH = Path(args.pack) if args.pack else BASE / 'images.pack'
+    PACK_URL_PREFIX = args.pack_prefix
+    OUTPUT_FORMAT = args.output_format
+    if args.no_quiz_files:
+        QUIZ_DIR = None
+    if (DERIVATIVES or NEAR_DUP or PACK_PATH is not None) and MIRROR_DIR is None:
+        MIRROR_DIR = BASE / 'images'
+    TARGET_PER_LABEL = args.target
+    HARVEST_WORKERS = args.workers
+    REQUESTS_PER_SECOND = args.rps
+    RETRIES = args.retries
+    PAGE_SIZE = args.page_size
+    HARVEST_MODE = args.mode
+    PARTITIONS = args.partitions
+    STREAM = args.stream
+
+
+def pool_size() -> int:
+    """Keep-alive connections needed so that no concurrent request has to open (and then discard) its own."""
+    # each cursor chain may have one read-ahead in flight; partitioned walks run a window of chains per label
+    chains = HARVEST_WORKERS * (1 + int(PREFETCH)) * max(1, PARTITION_WINDOW if PARTITIONS > 1 else 1)
+    return max(chains, MIRROR_WORKERS if MIRROR_DIR is not None else 1)
+
+
+def selection(args) -> tuple:
+    """(labels to harvest, modules to build), both in their declared order."""
+    modules = [m for m in MODULES if not args.modules or m in args.modules]
+    if args.labels:
+        labels = [k for k in LABEL_QUERIES if k in args.labels]
+        if not args.modules:
+            # only modules whose labels are all being refreshed
+            modules = [m for m in modules if all(k in labels for k in MODULES[m])]
+    elif args.modules:
+        labels = [k for k in LABEL_QUERIES if any(k in MODULES[m] for m in modules)]
+    else:
+        labels = list(LABEL_QUERIES)
+    return labels, modules
+
+
+def case_table(modules: dict) -> tuple:
+    """(cases by id, modules whose sets list case ids): the normalized layout of output format 2."""
+    cases = {}
+    refs = {}
+    for name, sets in modules.items():
+        refs[name] = []
+        for s in sets:
+            for case in s:
+                if case['id'] not in cases:
+                    d = case.to_dict() if isinstance(case, Case) else dict(case)
+                    del d['id']
+                    cases[case['id']] = d
+            refs[name].append([case['id'] for case in s])
+    return cases, refs
+
+
+def expand_modules(payload: dict) -> dict:
+    """Modules with full case dicts, from either output format."""
+    modules = payload.get('modules') or {}
+    if payload.get('format', 1) < 2:
+        return modules
+    cases = payload.get('cases') or {}
+    return {name: [[dict(cases[i], id=i) for i in s if i in cases] for s in sets] for name, sets in modules.items()}
+
+
+def write_atomic(path: Path, text: str):
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(text, encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def module_preview(case) -> dict:
+    # just what a module card needs to show its first image
+    preview = {'id': case['id'], 'imageUrl': case['imageUrl']}
+    images = case.get('images') or {}
+    if images.get('preview'):
+        preview['images'] = {'preview': images['preview']}
+    return preview
+
+
+def write_quiz_files(meta: dict, modules: dict) -> Path:
+    """QUIZ_DIR/manifest.json plus one <module>/set-<n>.<hash>.json per set.
+
+    The manifest holds titles, labels, set sizes and one preview case per set, so the
+    first paint does not grow with the number of cases. Set files are named by content
+    and can be cached indefinitely. The previous manifest's files survive one more run,
+    so a browser still holding that manifest can load its sets; older files are removed.
+    """
+    QUIZ_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = {'version': 1, 'meta': meta, 'modules': {}}
+    manifest_path = QUIZ_DIR / 'manifest.json'
+    try:
+        previous = json.loads(manifest_path.read_text(encoding='utf-8'))
+        keep = {QUIZ_DIR / s['file'] for m in previous['modules'].values() for s in m['sets']}
+    except (OSError, ValueError, KeyError, TypeError):
+        keep = set()
+    listed = set()
+    for name, sets in modules.items():
+        entries = []
+        for n, s in enumerate(sets, 1):
+            cases = [c.to_dict() if isinstance(c, Case) else dict(c) for c in s]
+            body = json.dumps({'module': name, 'set': n, 'cases': cases}, ensure_ascii=False, separators=(',', ':'))
+            rel = f'{name}/set-{n}.{hashlib.sha256(body.encode("utf-8")).hexdigest()[:12]}.json'
+            path = QUIZ_DIR / rel
+            if not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                write_atomic(path, body)
+            listed.add(path)
+            # per set: the app may hide a module's first sets and show the next one's image
+            entries.append({'file': rel, 'size': len(cases), 'preview': module_preview(s[0]) if s else None})
+        manifest['modules'][name] = {
+            'title': MODULE_TITLES.get(name, name),
+            'labels': list(MODULES.get(name, ())) if sets else [],
+            'preview': entries[0]['preview'] if entries else None,
+            'sets': entries,
+        }
+    write_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+    for old in QUIZ_DIR.glob('*/set-*.json'):
+        if old not in listed and old not in keep:
+            old.unlink()
+    return manifest_path
+
+
+def previous_modules() -> dict:
+    # partial rebuilds keep the modules they did not touch
+    try:
+        return expand_modules(json.loads(OUT_PATH.read_text(encoding='utf-8')))
+    except (OSError, ValueError):
+        return {}
+
+
+def checkpoint_store(ck: dict):
+    """Open the candidate store a checkpoint's cursors belong to, or refuse to run without it.
+
+    Once buckets live in the store the checkpoint only keeps the cursors; resuming those
+    cursors with empty buckets would skip every case before them.
+    """
+    global STORE_PATH
+    recorded = ck.get('store')
+    if not recorded:
+        return
+    if STORE_PATH is None:
+        STORE_PATH = Path(recorded)
+        print(f'using candidate store {STORE_PATH} (recorded in {CK_PATH.name})')
+    elif Path(STORE_PATH).resolve() != Path(recorded).resolve():
+        raise RuntimeError(f'{CK_PATH} belongs to candidate store {recorded}, not {STORE_PATH}')
+    if not Path(STORE_PATH).exists():
+        raise RuntimeError(f'candidate store {STORE_PATH} is missing; its cursors in {CK_PATH} cannot be resumed without it')
+
+
+def main(argv=None):
+    global STORE, ARCHIVE, PROFILER
+    args = parse_args(argv)
+    configure(args)
+    labels, module_names = selection(args)
     BASE.mkdir(parents=True, exist_ok=True)
+    if args.profile is not None and not args.plan:
+        PROFILER = isic_profile.StageProfiler(args.profile)
+        PROFILER.start()
+    isic_http.configure(pool_size=pool_size())
+    isic_http.configure_cache(CACHE_DIR, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES)
+    isic_http.configure_limiter(REQUESTS_PER_SECOND)
+
+    if ARCHIVE_DIR is not None and not args.plan:
+        ARCHIVE = isic_store.RawArchive(ARCHIVE_DIR)
+    elif OFFLINE:
+        raise RuntimeError('OFFLINE rebuild needs ARCHIVE_DIR')
 
-    ck = load_ck() or {}
+    # offline: start from empty buckets so the current filters see every archived record
+    ck = {} if OFFLINE else (load_ck() or {})
     state = {
-        'version': 4,
+        'version': 5,
         'buckets': ck.get('buckets') or {k: [] for k in LABEL_QUERIES.keys()},
     }
+    for pk in ('clinical', 'multiplex_clinical', 'partition_clinical'):
+        if ck.get(pk):
+            state[pk] = ck[pk]
+    # one Case object per case, shared by the state and the harvest buckets
+    for key in ('buckets', 'clinical', 'multiplex_clinical', 'partition_clinical'):
+        for label, cases in state.get(key, {}).items():
+            state[key][label] = [Case.from_dict(x) for x in cases]
     # keep old next cursors if present
-    for k in LABEL_QUERIES.keys():
-        nk = f'next_{k}'
+    for nk in [f'{p}_{k}' for p in ('next', 'partition') for k in LABEL_QUERIES.keys()] + ['multiplex_query', 'multiplex_next']:
         if ck.get(nk):
             state[nk] = ck[nk]
+    state['journal_seq'] = ck.get('journal_seq', 0)
+    if not OFFLINE:
+        checkpoint_store(ck)
 
-    buckets = state['buckets']
+    if args.plan:
+        if STORE_PATH is not None and Path(STORE_PATH).exists():
+            STORE = isic_store.CandidateStore(STORE_PATH)
+        try:
+            print_plan(plan_harvest(state, labels, TARGET_PER_LABEL))
+        finally:
+            if STORE is not None:
+                STORE.close()
+                STORE = None
+        return
 
-    # harvest each label with histopathology-only filter
-    for label, query in LABEL_QUERIES.items():
-        buckets[label] = harvest_label(label, query, state, TARGET_PER_LABEL)
-        print(f"{label}: {len(buckets[label])}")
+    if STORE_PATH is not None and not OFFLINE:
+        STORE = isic_store.CandidateStore(STORE_PATH)
+        # one-time migration: checkpoint buckets move into the store, which is authoritative from then on
+        for label, cases in state['buckets'].items():
+            if cases and STORE.count(label) == 0:
+                STORE.add_many(label, cases)
+        state['buckets'] = {}
+        state['store'] = str(Path(STORE_PATH).resolve())
+        buckets = {}
+    else:
+        buckets = state['buckets']
 
-    modules = {
-        'mel_vs_nevus': build_sets(buckets['melanoma'], buckets['nevus'], nsets=3),
-        'bcc_vs_sh': build_sets(buckets['bcc'], buckets['sebaceous_hyperplasia'], nsets=3),
-        'bcc_vs_bowen': build_sets(buckets['bcc'], buckets['bowen'], nsets=3),
-    }
+    # fold any replayed journal into a fresh snapshot before harvesting
+    save_ck(state)
+
+    METRICS.reset()
+    with stage('harvest'):
+        per_label = {} if args.only_build else {k: LABEL_QUERIES[k] for k in labels}
+        if HARVEST_MODE == 'multiplex' and per_label:
+            harvested = harvest_multiplexed(state, TARGET_PER_LABEL, labels)
+            with CK_LOCK:
+                buckets.update(harvested)
+            for label, bucket in harvested.items():
+                print(f"{label}: {len(bucket)}")
+            # labels whose query is not a plain diagnosis_3 match still get their own walk
+            per_label = {k: q for k, q in per_label.items() if k not in harvested}
+
+        # harvest each label with histopathology-only filter; labels are independent,
+        # so running them concurrently does not change any bucket's contents
+        with ThreadPoolExecutor(max_workers=max(1, HARVEST_WORKERS)) as pool:
+            futures = {
+                label: pool.submit(harvest_label, label, query, state, TARGET_PER_LABEL)
+                for label, query in per_label.items()
+            }
+            # one failing label must not discard the others: wait for all of them, then checkpoint
+            failed = []
+            for label, fut in futures.items():
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    print(f"{label}: failed ({type(e).__name__}: {e})")
+                    failed.append(e)
+                    continue
+                with CK_LOCK:
+                    buckets[label] = result
+                print(f"{label}: {len(result)}")
+            if failed:
+                save_ck(state)
+                raise failed[0]
+
+    if STORE is not None:
+        # the store holds every label, including the ones this run did not harvest
+        for label in LABEL_QUERIES:
+            buckets.setdefault(label, STORE.bucket(label))
+
+    candidates = {}
+    if NEAR_DUP and MIRROR_DIR is not None:
+        with stage('near_dup'):
+            candidates = drop_near_duplicates(buckets)
+        if not args.only_build:
+            candidates = refill_near_duplicates(state, buckets, candidates, labels)
+
+    with stage('build_sets'):
+        modules = previous_modules() if len(module_names) < len(MODULES) else {}
+        for name in module_names:
+            a, b = MODULES[name]
+            a_cases = candidates[a] if a in candidates else set_candidates(buckets, a)
+            b_cases = candidates[b] if b in candidates else set_candidates(buckets, b)
+            for label, cases in ((a, a_cases), (b, b_cases)):
+                # build_sets(nsets=3) wants 5 per class per set
+                if len(cases) < 3 * 5:
+                    print(f'warning: {label} has {len(cases)} of {3 * 5} set candidates; {name} gets smaller sets or none')
+            modules[name] = build_sets(a_cases, b_cases, nsets=3)
+        modules = {name: modules[name] for name in MODULES if name in modules}
+
+    if MIRROR_DIR is not None and modules:
+        with stage('mirror'):
+            modules = mirror_images(modules)
+    if DERIVATIVES and MIRROR_DIR is not None and modules:
+        with stage('derivatives'):
+            modules = add_derivatives(modules)
+    if PACK_PATH is not None and MIRROR_DIR is not None and modules:
+        with stage('pack'):
+            modules = pack_images(modules)
 
     set_sizes = {k: [len(s) for s in v] for k, v in modules.items()}
     counts = {k: len(v) for k, v in buckets.items()}
@@ -227,9 +1440,33 @@ def main():
         },
         'modules': modules,
     }
+    if OUTPUT_FORMAT >= 2:
+        # a case shared by modules (bcc) is written once
+        cases, payload['modules'] = case_table(modules)
+        payload = dict({'format': 2}, **payload, cases=cases)
 
-    OUT_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding='utf-8')
+    with stage('write_output'):
+        OUT_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2, default=json_default), encoding='utf-8')
+        if QUIZ_DIR is not None:
+            write_quiz_files(payload['meta'], modules)
+        elif (BASE / 'quiz' / 'manifest.json').exists():
+            # app.js prefers the manifest: an old one would keep serving old sets
+            (BASE / 'quiz' / 'manifest.json').unlink()
+            print(f"removed {BASE / 'quiz' / 'manifest.json'}: quiz files are disabled")
     save_ck(state)
+    if STORE is not None:
+        STORE.close()
+        STORE = None
+
+    if METRICS_PATH is not None:
+        METRICS.write_json(METRICS_PATH)
+    if HISTORY_PATH is not None and not OFFLINE:
+        update_history(HISTORY_PATH, METRICS.snapshot())
+    if METRICS_PROM_PATH is not None:
+        METRICS.write_prometheus(METRICS_PROM_PATH)
+    if PROFILER is not None:
+        print(f'profile written to {PROFILER.finish()}')
+        PROFILER = None
 
     print(json.dumps(payload['meta'], ensure_ascii=False, indent=2))
 
@@ -0,0 +1,146 @@
+"""
+Stichting HUID - kleinere afgeleide afbeeldingen voor de quiz.
+
+Uit elk gespiegeld origineel (isic_mirror) worden per formaat (AVIF waar Pillow
+het kan, anders alleen WebP) een thumbnail, een preview voor de modulekaart en
+twee quizbreedtes gemaakt. EXIF/XMP worden niet meegeschreven; oriëntatie en
+kleurprofiel worden eerst toegepast.
+
+- Werk in een procespool: decoderen en encoderen is CPU-werk.
+- Bestanden heten derived/ab/<sha256 origineel>-<breedte>w-v<VERSION>.<fmt>, dus
+  een herhaalde run slaat alles over wat al bestaat (derived.json onthoudt de maten).
+
+Pillow is optioneel: zonder Pillow werkt de builder gewoon, alleen --derivatives niet.
+"""
+
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+try:
+    from PIL import Image, ImageCms, ImageOps, features
+except ImportError:  # optional dependency, see available()
+    Image = None
+
+VERSION = 1  # bump when sizes or encoder settings change: derivatives get new names
+SIZES = (('thumb', 160), ('preview', 480), ('quiz', 640), ('quiz', 1024))  # (use, max width)
+SAVE_OPTIONS = {'avif': {'quality': 55}, 'webp': {'quality': 78, 'method': 6}}
+FORMATS = ('avif', 'webp')  # preferred first; unsupported ones are skipped
+ORIENTATION = 0x0112  # EXIF tag
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def supported_formats() -> tuple:
+    out = []
+    for fmt in FORMATS:
+        try:
+            if features.check(fmt):
+                out.append(fmt)
+        except ValueError:  # feature unknown to this Pillow version
+            pass
+    return tuple(out)
+
+
+def _to_srgb(im):
+    icc = im.info.get('icc_profile')
+    if icc:
+        try:
+            src = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+            im = ImageCms.profileToProfile(im, src, ImageCms.createProfile('sRGB'), outputMode='RGB')
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            pass  # unreadable profile: keep the pixels as they are
+    return im.convert('RGB')
+
+
+def one_per_width(variants: List[dict]) -> List[dict]:
+    # a narrow original caps several sizes of one use at the same width; srcset wants each width once
+    seen = set()
+    out = []
+    for v in variants:
+        if (v['use'], v['width']) not in seen:
+            seen.add((v['use'], v['width']))
+            out.append(v)
+    return out
+
+
+def render(src: str, out_root: str, digest: str, formats: tuple) -> List[dict]:
+    """Worker: write every derivative of one original; returns [{use, width, height, bytes, <fmt>: relpath}]."""
+    out_root = Path(out_root)
+    variants = []
+    with Image.open(src) as im:
+        widest = max(w for _, w in SIZES)
+        # JPEG: decode at the smallest power-of-two scale that is still at least as large as needed;
+        # EXIF orientations 5-8 swap width and height
+        w, h = (im.height, im.width) if im.getexif().get(ORIENTATION, 1) in (5, 6, 7, 8) else im.size
+        need = (widest, max(1, round(h * widest / w)))
+        im.draft('RGB', need[::-1] if (w, h) != im.size else need)
+        im = _to_srgb(ImageOps.exif_transpose(im))
+        # encoders copy exif/xmp/icc_profile from info by default; the pixels are sRGB now
+        im.info = {}
+        done = {}
+        for use, max_width in SIZES:
+            width = min(max_width, im.width)  # never upscale
+            height = max(1, round(im.height * width / im.width))
+            if width not in done:
+                resized = im if width == im.width else im.resize((width, height), Image.LANCZOS)
+                entry = {'width': width, 'height': height, 'bytes': 0}
+                for fmt in formats:
+                    rel = f'derived/{digest[:2]}/{digest}-{width}w-v{VERSION}.{fmt}'
+                    path = out_root / rel
+                    if not path.exists():
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+                        resized.save(tmp, format=fmt.upper(), **SAVE_OPTIONS[fmt])
+                        os.replace(tmp, path)
+                    entry[fmt] = rel
+                    entry['bytes'] += path.stat().st_size
+                done[width] = entry
+            variants.append(dict(done[width], use=use))
+    return one_per_width(variants)
+
+
+class DerivativeStore:
+    """Runs render() over many originals and remembers the results in <root>/derived.json."""
+
+    def __init__(self, root: Path, workers: int = None):
+        self.root = Path(root)
+        self.workers = workers or os.cpu_count() or 1
+        self.formats = supported_formats()
+        self.manifest_path = self.root / 'derived.json'
+        try:
+            self.manifest = json.loads(self.manifest_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.manifest = {}
+        if self.manifest.get('version') != VERSION or self.manifest.get('formats') != list(self.formats):
+            self.manifest = {'version': VERSION, 'formats': list(self.formats), 'images': {}}
+
+    def _complete(self, variants: List[dict]) -> bool:
+        return all((self.root / v[fmt]).exists() for v in variants for fmt in self.formats)
+
+    def build(self, originals: Dict[str, Path]) -> Dict[str, List[dict]]:
+        """{sha256: original path} -> {sha256: variants}; originals that fail to decode are left out."""
+        images = self.manifest['images']
+        todo = {d: p for d, p in originals.items() if d not in images or not self._complete(images[d])}
+        if todo:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(todo))) as pool:
+                futures = {d: pool.submit(render, str(p), str(self.root), d, self.formats) for d, p in todo.items()}
+                for d, fut in futures.items():
+                    try:
+                        images[d] = fut.result()
+                    except (OSError, ValueError, Image.DecompressionBombError) as e:
+                        print(f'derivatives: {originals[d]}: {e}')
+            self.save()
+        # derived.json entries written before one_per_width may still list a width twice
+        return {d: one_per_width(images[d]) for d in originals if d in images}
+
+    def save(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.manifest, indent=1, sort_keys=True), encoding='utf-8')
+        os.replace(tmp, self.manifest_path)
@@ -0,0 +1,474 @@
+"""
+Stichting HUID - gedeelde HTTP-laag voor de dataset builder.
+
+Eén requests.Session per proces, zodat alle cursor-pagina's dezelfde
+keep-alive verbindingen (en TLS-sessies) naar de ISIC API hergebruiken.
+Optioneel een persistente response-cache op schijf (TTL, LRU, ETag/Last-Modified).
+Alle netwerkverzoeken delen één adaptieve token-bucket rate limiter.
+stream_json() parseert zoekpagina's terwijl ze binnenkomen (zie isic_stream).
+"""
+
+import codecs
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from isic_metrics import METRICS
+from isic_stream import CHUNK_SIZE, StreamedPage
+
+POOL_SIZE = 8  # keep-alive connections per host; build_isic_sets sizes it to its concurrent requests
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 45
+
+REQUESTS_PER_SECOND = 12.0
+BURST = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 20.0
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class RetryableError(Exception):
+    """Transient failure (timeout, connection reset, 429, 5xx); retry_after is the server's hint, if any."""
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FatalHTTPError(Exception):
+    """Non-retryable failure (4xx other than 408/429, an unusable URL); retrying cannot help."""
+
+
+# request errors that say the request itself is wrong; every other RequestException
+# (reset, timeout, truncated chunked body, bad gzip stream) is worth another attempt
+FATAL_REQUEST_ERRORS = (
+    requests.exceptions.InvalidURL,
+    requests.exceptions.MissingSchema,
+    requests.exceptions.InvalidSchema,
+    requests.exceptions.InvalidHeader,
+    requests.exceptions.URLRequired,
+    requests.exceptions.TooManyRedirects,
+)
+
+
+class RateLimiter:
+    """Token bucket shared by all harvest threads, with AIMD adaptation to 429/503."""
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, burst: int = BURST, min_rate: float = 0.25):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.slept = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.slept += waited
+                    return waited
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+            waited += wait
+
+    def penalize(self, retry_after: float = None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                # everyone waits out the server's Retry-After, not just the thread that got it
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self.tokens = min(self.tokens, 0.0)
+
+    def reward(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1 * self.max_rate)
+
+
+_limiter = RateLimiter()
+
+
+def configure_limiter(rate: float = None, burst: int = None):
+    global _limiter
+    _limiter = RateLimiter(rate if rate is not None else REQUESTS_PER_SECOND, burst if burst is not None else BURST)
+
+
+def retry_after_seconds(value) -> float:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    # full jitter keeps concurrent workers from retrying in lockstep
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _new_session() -> requests.Session:
+    s = requests.Session()
+    # retries are handled by the caller; the adapter only pools connections
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    s.headers.update({'Accept': 'application/json', 'Connection': 'keep-alive'})
+    return s
+
+
+def configure(pool_size: int = None, connect_timeout: float = None, read_timeout: float = None):
+    global POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+    if pool_size is not None:
+        POOL_SIZE = max(1, int(pool_size))
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    close()
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _new_session()
+        return _session
+
+
+def close():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get(url: str, params=None, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().get(url, params=params, **kwargs)
+
+
+def _checked_get(url: str, params=None, headers=None, label: str = '', stream: bool = False) -> requests.Response:
+    """Rate-limited GET that turns failures into RetryableError / FatalHTTPError.
+
+    With stream=True only the headers have been read on return; the caller reads the body.
+    """
+    waited = _limiter.acquire()
+    if waited:
+        METRICS.inc('sleep_seconds_total', waited, kind='rate_limit', label=label)
+    t0 = time.perf_counter()
+    try:
+        r = get(url, params=params, headers=headers, stream=stream)
+    except FATAL_REQUEST_ERRORS as e:
+        METRICS.inc('http_requests_total', label=label, status=type(e).__name__)
+        raise FatalHTTPError(f'{type(e).__name__}: {e}') from e
+    except requests.RequestException as e:
+        METRICS.inc('http_requests_total', label=label, status=type(e).__name__)
+        raise RetryableError(f'{type(e).__name__}: {e}') from e
+    METRICS.observe('http_request_seconds', time.perf_counter() - t0, label=label)
+    METRICS.inc('http_requests_total', label=label, status=r.status_code)
+    if not stream or r.status_code >= 300:
+        METRICS.inc('http_bytes_received_total', len(r.content), label=label)
+
+    if r.status_code in (429, 503):
+        retry_after = retry_after_seconds(r.headers.get('Retry-After'))
+        _limiter.penalize(retry_after)
+        raise RetryableError(f'HTTP {r.status_code}', retry_after)
+    if r.status_code >= 500 or r.status_code == 408:
+        raise RetryableError(f'HTTP {r.status_code}')
+    if r.status_code >= 400:
+        raise FatalHTTPError(f'HTTP {r.status_code}: {r.text[:200]}')
+    _limiter.reward()
+    return r
+
+
+def _decode(r: requests.Response):
+    try:
+        return r.json()
+    except ValueError as e:
+        # truncated or garbled body; a retry usually fixes it
+        raise RetryableError(f'invalid JSON: {e}') from e
+
+
+class ResponseCache:
+    """On-disk JSON response cache keyed by URL + params, with TTL, size cap and LRU eviction."""
+
+    def __init__(self, root: Path, ttl: float = 7 * 24 * 3600, max_bytes: int = 256 * 1024 * 1024):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total = sum(p.stat().st_size for p in self.root.glob('*/*.json'))
+
+    @staticmethod
+    def key(url: str, params=None) -> str:
+        q = urlencode(sorted((params or {}).items()))
+        return hashlib.sha256(f'{url}?{q}'.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f'{key}.json'
+
+    def load(self, key: str):
+        p = self._path(key)
+        try:
+            entry = json.loads(p.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        # LRU: mtime doubles as last-access time
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        return (time.time() - entry.get('stored_at', 0)) < self.ttl
+
+    @staticmethod
+    def _entry(url: str, body: str, etag: str = '', last_modified: str = '') -> dict:
+        return {
+            'url': url,
+            'stored_at': time.time(),
+            'etag': etag or '',
+            'last_modified': last_modified or '',
+            'body': body,
+        }
+
+    def _tmp_path(self, key: str) -> Path:
+        p = self._path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        return p.with_suffix(f'.{threading.get_ident()}.tmp')
+
+    def _commit(self, key: str, tmp: Path):
+        p = self._path(key)
+        size = tmp.stat().st_size
+        with self._lock:
+            old = p.stat().st_size if p.exists() else 0
+            os.replace(tmp, p)
+            self._total += size - old
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def store(self, key: str, url: str, body: str, etag: str = '', last_modified: str = ''):
+        data = json.dumps(self._entry(url, body, etag, last_modified), ensure_ascii=False).encode('utf-8')
+        tmp = self._tmp_path(key)
+        tmp.write_bytes(data)
+        self._commit(key, tmp)
+
+    def writer(self, key: str, url: str, etag: str = '', last_modified: str = '') -> 'CacheWriter':
+        return CacheWriter(self, key, url, etag, last_modified)
+
+    def refresh(self, key: str, entry: dict):
+        # 304 Not Modified: keep the body, restart the TTL
+        self.store(key, entry['url'], entry['body'], entry.get('etag', ''), entry.get('last_modified', ''))
+
+    def _evict(self):
+        files = []
+        for p in self.root.glob('*/*.json'):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        files.sort()
+        self._total = sum(f[1] for f in files)
+        # drop least recently used entries until we are 10% under the cap
+        limit = self.max_bytes * 0.9
+        for _, size, p in files:
+            if self._total <= limit:
+                break
+            try:
+                p.unlink()
+                self._total -= size
+            except OSError:
+                pass
+
+
+class CacheWriter:
+    """Writes a cache entry while the body streams in; only a complete body is committed."""
+
+    def __init__(self, cache: ResponseCache, key: str, url: str, etag: str = '', last_modified: str = ''):
+        self.cache = cache
+        self.key = key
+        self.tmp = cache._tmp_path(key)
+        self.f = open(self.tmp, 'w', encoding='utf-8')
+        # same file format as store(): the body is a JSON string, escaped chunk by chunk
+        entry = cache._entry(url, '', etag, last_modified)
+        del entry['body']
+        self.f.write(json.dumps(entry, ensure_ascii=False)[:-1] + ', "body": "')
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def write(self, chunk: bytes):
+        text = self.decoder.decode(chunk)
+        if text:
+            self.f.write(json.dumps(text, ensure_ascii=False)[1:-1])
+
+    def commit(self):
+        tail = self.decoder.decode(b'', final=True)
+        if tail:
+            self.f.write(json.dumps(tail, ensure_ascii=False)[1:-1])
+        self.f.write('"}')
+        self.f.close()
+        self.cache._commit(self.key, self.tmp)
+
+    def abort(self):
+        self.f.close()
+        try:
+            self.tmp.unlink()
+        except OSError:
+            pass
+
+
+_cache = None
+
+
+def configure_cache(root, ttl: float = None, max_bytes: int = None):
+    global _cache
+    if root is None:
+        _cache = None
+        return
+    kwargs = {}
+    if ttl is not None:
+        kwargs['ttl'] = ttl
+    if max_bytes is not None:
+        kwargs['max_bytes'] = max_bytes
+    _cache = ResponseCache(root, **kwargs)
+
+
+def get_json(url: str, params=None, label: str = ''):
+    """One GET through the cache: fresh hits skip the network, stale hits revalidate."""
+    if _cache is None:
+        return _decode(_checked_get(url, params=params, label=label))
+
+    key = _cache.key(url, params)
+    entry = _cache.load(key)
+    if entry is not None and _cache.is_fresh(entry):
+        METRICS.inc('http_cache_total', label=label, result='hit')
+        return json.loads(entry['body'])
+
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    r = _checked_get(url, params=params, headers=headers, label=label)
+    if r.status_code == 304 and entry is not None:
+        METRICS.inc('http_cache_total', label=label, result='revalidated')
+        _cache.refresh(key, entry)
+        return json.loads(entry['body'])
+    METRICS.inc('http_cache_total', label=label, result='miss')
+    data = _decode(r)
+    _cache.store(key, url, r.text, r.headers.get('ETag', ''), r.headers.get('Last-Modified', ''))
+    return data
+
+
+class _BodyStream:
+    """Byte chunks of a streamed response; feeds the metrics and, if given, a cache writer."""
+
+    def __init__(self, r: requests.Response, label: str = '', writer: CacheWriter = None):
+        self.r = r
+        self.label = label
+        self.writer = writer
+
+    def __iter__(self):
+        try:
+            for chunk in self.r.iter_content(CHUNK_SIZE):
+                METRICS.inc('http_bytes_received_total', len(chunk), label=self.label)
+                if self.writer is not None:
+                    self.writer.write(chunk)
+                yield chunk
+        except requests.RequestException as e:
+            # reset or timeout mid-body: the page is requested again
+            raise RetryableError(f'{type(e).__name__}: {e}') from e
+
+    def close(self, complete: bool = False):
+        if self.writer is not None:
+            if complete:
+                self.writer.commit()
+            else:
+                self.writer.abort()
+            self.writer = None
+        self.r.close()
+
+
+def _body_stream(r: requests.Response, url: str, params=None, label: str = '') -> _BodyStream:
+    if r.status_code != 200:
+        r.close()
+        raise RetryableError(f'HTTP {r.status_code} for a streamed request')
+    writer = None
+    if _cache is not None:
+        writer = _cache.writer(_cache.key(url, params), url, r.headers.get('ETag', ''), r.headers.get('Last-Modified', ''))
+    return _BodyStream(r, label, writer)
+
+
+def open_body(url: str, params=None, label: str = '') -> _BodyStream:
+    """GET with a streamed 200 body; the body is cached once it has been read completely."""
+    return _body_stream(_checked_get(url, params=params, label=label, stream=True), url, params, label)
+
+
+def stream_json(url: str, params=None, label: str = '', reopen=None, restarts: int = 2):
+    """Like get_json, but a downloaded page comes back as a StreamedPage parsed while it arrives.
+
+    Cache hits and 304 revalidations return the cached page as a dict. `reopen` is
+    called (and must return a fresh open_body()) when the body breaks off mid-way.
+    """
+    entry = None
+    if _cache is not None:
+        key = _cache.key(url, params)
+        entry = _cache.load(key)
+        if entry is not None and _cache.is_fresh(entry):
+            METRICS.inc('http_cache_total', label=label, result='hit')
+            return json.loads(entry['body'])
+
+    if entry is not None:
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        r = _checked_get(url, params=params, headers=headers, label=label, stream=True)
+        if r.status_code == 304:
+            r.close()
+            METRICS.inc('http_cache_total', label=label, result='revalidated')
+            _cache.refresh(key, entry)
+            return json.loads(entry['body'])
+        body = _body_stream(r, url, params, label)
+    else:
+        body = open_body(url, params=params, label=label)
+    if _cache is not None:
+        METRICS.inc('http_cache_total', label=label, result='miss')
+    return StreamedPage(body, reopen=reopen, restarts=restarts, retry_on=(RetryableError,))
@@ -0,0 +1,177 @@
+"""
+Stichting HUID - compacte id-sets en case-records voor grote harvests.
+
+- IdSet: ISIC-ids ('ISIC_0001109', 'IL_0000123') als integers in een gesorteerde
+  array; lookups via bisect, nieuwe ids eerst in een kleine set en batchgewijs
+  samengevoegd.
+- Case: één geaccepteerde case met __slots__ in plaats van een dict per case;
+  leest als een dict (case['id'], case.get('lesionId')) en serialiseert naar
+  precies dezelfde JSON.
+"""
+
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+ID_DIGITS = 7  # ISIC_0001109, IL_0000123
+
+
+def id_key(value: str, digits: int = ID_DIGITS):
+    """'ISIC_0001109' -> (prefix 'ISIC_', 1109); None for anything that would not round-trip exactly."""
+    head, sep, tail = value.rpartition('_')
+    if not sep or len(tail) != digits or not tail.isdigit() or not tail.isascii():
+        return None
+    return head + sep, int(tail)
+
+
+class IdSet:
+    """Set of ISIC-style id strings, stored as sorted 64-bit ints per prefix.
+
+    Supports the subset of set() that add_case needs (in, add, len, iter). Ids that do
+    not parse as <prefix>_<7 digits> live in a plain fallback set.
+    """
+
+    MIN_MERGE = 1024
+
+    def __init__(self, ids: Iterable[str] = ()):
+        self._sorted = {}  # prefix -> array('q'), ascending
+        self._recent = {}  # prefix -> set of ints not yet merged
+        self._other = set()
+        self._len = 0
+        for x in ids:
+            self.add(x)
+
+    def _has(self, prefix: str, n: int) -> bool:
+        if n in self._recent.get(prefix, ()):
+            return True
+        arr = self._sorted.get(prefix)
+        if not arr:
+            return False
+        i = bisect_left(arr, n)
+        return i < len(arr) and arr[i] == n
+
+    def __contains__(self, value) -> bool:
+        k = id_key(value) if isinstance(value, str) else None
+        if k is None:
+            return value in self._other
+        return self._has(*k)
+
+    def add(self, value):
+        k = id_key(value) if isinstance(value, str) else None
+        if k is None:
+            if value not in self._other:
+                self._other.add(value)
+                self._len += 1
+            return
+        prefix, n = k
+        arr = self._sorted.get(prefix)
+        if arr is None:
+            arr = self._sorted[prefix] = array('q')
+        recent = self._recent.get(prefix)
+        if not recent and (not arr or n > arr[-1]):
+            # search pages come in isic_id order, so most ids simply extend the array
+            arr.append(n)
+            self._len += 1
+            return
+        if self._has(prefix, n):
+            return
+        if recent is None:
+            recent = self._recent[prefix] = set()
+        recent.add(n)
+        self._len += 1
+        # merge when the buffer reaches a fraction of the array: few O(n) merges, small buffer
+        if len(recent) >= max(self.MIN_MERGE, len(arr) // 8):
+            self._merge(prefix)
+
+    def _merge(self, prefix: str):
+        arr = self._sorted[prefix]
+        arr.extend(sorted(self._recent.pop(prefix)))
+        # two ascending runs: timsort merges them in linear time
+        self._sorted[prefix] = array('q', sorted(arr))
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[str]:
+        for prefix in sorted(set(self._sorted) | set(self._recent)):
+            ints = list(self._sorted.get(prefix, ())) + sorted(self._recent.get(prefix, ()))
+            for n in sorted(ints):
+                yield f'{prefix}{n:0{ID_DIGITS}d}'
+        yield from self._other
+
+
+class Case:
+    """One accepted case. Fields match the output JSON; later stages may add keys (kept in `extra`)."""
+
+    FIELDS = ('id', 'lesionId', 'imageUrl', 'diagnosis', 'source')
+    __slots__ = FIELDS + ('extra',)
+    _FIELDS = frozenset(FIELDS)
+
+    def __init__(self, id: str, lesionId: str, imageUrl: str, diagnosis: str, source: str):
+        self.id = id
+        self.lesionId = lesionId
+        self.imageUrl = imageUrl
+        self.diagnosis = diagnosis
+        self.source = source
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, d) -> 'Case':
+        if isinstance(d, Case):
+            return d
+        # a handful of distinct label/source values: share one string object each
+        case = cls(d['id'], d.get('lesionId', '') or '', d.get('imageUrl', ''), sys.intern(d.get('diagnosis', '')), sys.intern(d.get('source', '')))
+        for k, v in d.items():
+            if k not in cls._FIELDS:
+                case[k] = v
+        return case
+
+    def __getitem__(self, key: str):
+        if key in self._FIELDS:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._FIELDS or (self.extra is not None and key in self.extra)
+
+    def get(self, key: str, default=None):
+        if key in self._FIELDS:
+            return getattr(self, key)
+        return self.extra.get(key, default) if self.extra is not None else default
+
+    def keys(self):
+        return list(self.FIELDS) + list(self.extra or ())
+
+    def to_dict(self) -> dict:
+        d = {'id': self.id, 'lesionId': self.lesionId, 'imageUrl': self.imageUrl, 'diagnosis': self.diagnosis, 'source': self.source}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Case, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, Case) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'Case({self.to_dict()!r})'
+
+
+def json_default(obj):
+    """json.dumps(..., default=json_default) for payloads that contain Case objects."""
+    if isinstance(obj, Case):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
@@ -0,0 +1,161 @@
+"""
+Stichting HUID - metrics voor harvest-runs.
+
+Thread-safe tellers en histogrammen met labels; na een run weggeschreven als
+JSON-rapport en optioneel als Prometheus textfile (node_exporter).
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# seconds; covers cache hits through slow API pages
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# add_case rejects in this order; acceptance rate per filter = passed / evaluated
+FILTER_ORDER = ('missing_id', 'duplicate_image', 'is_dermoscopic', 'missing_url', 'is_histopathology', 'lesion_dedup')
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self) -> dict:
+        cumulative, running = {}, 0
+        for le, c in zip(list(self.buckets) + ['+Inf'], self.counts):
+            running += c
+            cumulative[str(le)] = running
+        return {'count': self.count, 'sum': round(self.sum, 6), 'buckets': cumulative}
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        k = _key(name, labels)
+        with self._lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        k = _key(name, labels)
+        with self._lock:
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = Histogram()
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def filter_rates(self) -> dict:
+        """Per label: how many records reached each add_case filter and how many passed it."""
+        outcomes = {}
+        with self._lock:
+            for (name, labels), v in self.counters.items():
+                if name == 'add_case_outcomes_total':
+                    d = dict(labels)
+                    outcomes.setdefault(d.get('label', ''), {})[d.get('outcome')] = v
+        out = {}
+        for label, o in sorted(outcomes.items()):
+            remaining = sum(o.values())
+            rates = {}
+            for f in FILTER_ORDER:
+                rejected = o.get(f, 0)
+                rates[f] = {
+                    'evaluated': remaining,
+                    'passed': remaining - rejected,
+                    'rate': round((remaining - rejected) / remaining, 4) if remaining else None,
+                }
+                remaining -= rejected
+            rates['accepted'] = o.get('accepted', 0)
+            out[label] = rates
+        return out
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(self.counters.items())]
+            histograms = [{'name': n, 'labels': dict(l), **h.as_dict()} for (n, l), h in sorted(self.histograms.items())]
+        return {
+            'started_at': self.started,
+            'generated_at': time.time(),
+            'duration_s': round(time.time() - self.started, 3),
+            'counters': counters,
+            'histograms': histograms,
+            'filters': self.filter_rates(),
+        }
+
+    def write_json(self, path: Path):
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(json.dumps(self.snapshot(), ensure_ascii=False, indent=2), encoding='utf-8')
+        os.replace(tmp, path)
+
+    def prometheus_text(self, prefix: str = 'isic_builder_') -> str:
+        def fmt(labels) -> str:
+            if not labels:
+                return ''
+            parts = []
+            for k, v in labels:
+                v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                parts.append(f'{k}="{v}"')
+            return '{' + ','.join(parts) + '}'
+
+        lines, typed = [], set()
+        with self._lock:
+            for (name, labels), v in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} counter')
+                    typed.add(name)
+                lines.append(f'{prefix}{name}{fmt(labels)} {v}')
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                    typed.add(name)
+                running = 0
+                for le, c in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    running += c
+                    lines.append(f'{prefix}{name}_bucket{fmt(labels + (("le", str(le)),))} {running}')
+                lines.append(f'{prefix}{name}_sum{fmt(labels)} {h.sum}')
+                lines.append(f'{prefix}{name}_count{fmt(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: Path):
+        # textfile collector reads whole files; write-then-rename avoids partial scrapes
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(self.prometheus_text(), encoding='utf-8')
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
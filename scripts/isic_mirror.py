@@ -0,0 +1,241 @@
+"""
+Stichting HUID - lokale spiegel van de quizafbeeldingen (content-addressed).
+
+- Elke afbeelding staat één keer op schijf onder haar SHA-256:
+  objects/ab/abcdef….jpg. Een bestand verandert dus nooit onder een bestaande
+  naam en dubbele afbeeldingen kosten geen extra ruimte.
+- index.json koppelt bron-URL -> hash, grootte, ETag/Last-Modified. Een
+  herhaalde run doet per bekende afbeelding alleen een voorwaardelijke GET
+  (304) en downloadt enkel nieuwe of gewijzigde afbeeldingen.
+- Downloads gaan via partial/<url-hash>.part en worden hervat met Range/If-Range.
+  Ze worden gecontroleerd op lengte (Content-Length/Content-Range) en, als de
+  ETag een gewone MD5 is (S3), op MD5.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable
+from urllib.parse import urlparse
+
+import requests
+
+import isic_http
+from isic_metrics import METRICS
+
+WORKERS = 8
+RETRIES = 4
+SAVE_EVERY = 50  # completed downloads between index saves, so an interrupted run keeps its progress
+CHUNK_SIZE = 256 * 1024
+EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp', 'image/avif': '.avif'}
+_MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class MirrorError(Exception):
+    """A download failed verification or kept failing; the case keeps its remote URL."""
+
+
+def _extension(url: str, content_type: str = '') -> str:
+    ext = EXTENSIONS.get((content_type or '').split(';')[0].strip().lower())
+    if ext:
+        return ext
+    suffix = PurePosixPath(urlparse(url).path).suffix.lower()
+    return suffix if suffix in EXTENSIONS.values() or suffix == '.jpeg' else '.jpg'
+
+
+class ImageMirror:
+    """Downloads images into `root` and maps their source URLs to local URLs under `url_prefix`.
+
+    With offline=True nothing is downloaded: only images already in the index are mapped.
+    """
+
+    def __init__(self, root: Path, url_prefix: str, workers: int = WORKERS, retries: int = RETRIES, offline: bool = False):
+        self.root = Path(root)
+        self.url_prefix = url_prefix.rstrip('/')
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.offline = offline
+        self.index_path = self.root / 'index.json'
+        self.partial_dir = self.root / 'partial'
+        self._lock = threading.Lock()
+        try:
+            self.index = json.loads(self.index_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.index = {'version': 1, 'images': {}}
+
+    def object_path(self, entry: dict) -> Path:
+        return self.root / entry['path']
+
+    def local_url(self, entry: dict) -> str:
+        return f"{self.url_prefix}/{entry['path']}"
+
+    def has_object(self, entry: dict) -> bool:
+        try:
+            return self.object_path(entry).stat().st_size == entry['size']
+        except OSError:
+            return False
+
+    def save_index(self):
+        with self._lock:
+            data = json.dumps(self.index, ensure_ascii=False, indent=1, sort_keys=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix('.tmp')
+        tmp.write_text(data, encoding='utf-8')
+        os.replace(tmp, self.index_path)
+
+    def sync(self, urls: Iterable[str]) -> Dict[str, dict]:
+        """Mirror every URL; returns {url: index entry} for the ones available locally."""
+        urls = list(dict.fromkeys(u for u in urls if u))
+        images = self.index['images']
+        if self.offline:
+            return {u: images[u] for u in urls if u in images and self.has_object(images[u])}
+
+        out = {}
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self._fetch_with_retries, u): u for u in urls}
+            for fut in as_completed(futures):
+                url = futures[fut]
+                try:
+                    entry = fut.result()
+                except (MirrorError, isic_http.FatalHTTPError) as e:
+                    METRICS.inc('mirror_images_total', result='failed')
+                    print(f'mirror: {url}: {e}')
+                    # an earlier good copy is still better than the remote URL
+                    entry = images.get(url) if url in images and self.has_object(images[url]) else None
+                if entry is not None:
+                    out[url] = entry
+                done += 1
+                if done % SAVE_EVERY == 0:
+                    self.save_index()
+        self.save_index()
+        return out
+
+    def _fetch_with_retries(self, url: str) -> dict:
+        for attempt in range(self.retries):
+            try:
+                return self._fetch(url)
+            except (isic_http.RetryableError, requests.RequestException, MirrorError) as e:
+                if attempt == self.retries - 1:
+                    raise MirrorError(f'giving up after {self.retries} attempts: {e}') from e
+                retry_after = getattr(e, 'retry_after', None)
+                time.sleep(isic_http.backoff_delay(attempt, retry_after))
+
+    def _fetch(self, url: str) -> dict:
+        with self._lock:
+            known = self.index['images'].get(url)
+        headers = {'Accept': 'image/*'}
+        if known is not None and self.has_object(known):
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+        else:
+            known = None
+
+        part = self.partial_dir / (hashlib.sha256(url.encode('utf-8')).hexdigest() + '.part')
+        part_meta = part.with_suffix('.json')
+        offset = part.stat().st_size if part.exists() else 0
+        validator = None
+        if offset and known is None:
+            try:
+                validator = json.loads(part_meta.read_text(encoding='utf-8')).get('validator')
+            except (OSError, ValueError):
+                validator = None
+            if validator:
+                # If-Range: the server sends the rest only if the image has not changed in between
+                headers['Range'] = f'bytes={offset}-'
+                headers['If-Range'] = validator
+
+        t0 = time.perf_counter()
+        try:
+            r = isic_http.get(url, headers=headers, stream=True)
+        except isic_http.FATAL_REQUEST_ERRORS as e:
+            raise isic_http.FatalHTTPError(f'{type(e).__name__}: {e}') from e
+        except requests.RequestException as e:
+            raise isic_http.RetryableError(f'{type(e).__name__}: {e}') from e
+        with r:
+            METRICS.observe('mirror_request_seconds', time.perf_counter() - t0)
+            if r.status_code == 304 and known is not None:
+                METRICS.inc('mirror_images_total', result='unchanged')
+                return known
+            if r.status_code in (429, 500, 502, 503, 504):
+                raise isic_http.RetryableError(f'HTTP {r.status_code}', isic_http.retry_after_seconds(r.headers.get('Retry-After')))
+            if r.status_code not in (200, 206):
+                raise isic_http.FatalHTTPError(f'HTTP {r.status_code}')
+
+            resumed = r.status_code == 206
+            if not resumed:
+                offset = 0
+            total = self._expected_size(r, offset)
+            etag = r.headers.get('ETag', '')
+            last_modified = r.headers.get('Last-Modified', '')
+            self.partial_dir.mkdir(parents=True, exist_ok=True)
+            part_meta.write_text(json.dumps({'url': url, 'validator': etag or last_modified}), encoding='utf-8')
+
+            sha, md5 = hashlib.sha256(), hashlib.md5()
+            if resumed:
+                with open(part, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        sha.update(chunk)
+                        md5.update(chunk)
+            size = offset
+            with open(part, 'ab' if resumed else 'wb') as f:
+                try:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        sha.update(chunk)
+                        md5.update(chunk)
+                        size += len(chunk)
+                        METRICS.inc('mirror_bytes_total', len(chunk))
+                except requests.RequestException as e:
+                    # keep the part file: the next attempt continues from here
+                    raise isic_http.RetryableError(f'{type(e).__name__}: {e}') from e
+            content_type = r.headers.get('Content-Type', '')
+
+        if total is not None and size != total:
+            if size > total:
+                self._drop_partial(part, part_meta)
+            raise MirrorError(f'incomplete download: {size} of {total} bytes')
+        m = _MD5_ETAG.match(etag)
+        if m and md5.hexdigest() != m.group(1):
+            self._drop_partial(part, part_meta)
+            raise MirrorError('MD5 does not match the ETag')
+
+        digest = sha.hexdigest()
+        rel = f'objects/{digest[:2]}/{digest}{_extension(url, content_type)}'
+        dest = self.root / rel
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if dest.exists() and dest.stat().st_size == size:
+            part.unlink()
+        else:
+            os.replace(part, dest)
+        part_meta.unlink(missing_ok=True)
+
+        entry = {'sha256': digest, 'path': rel, 'size': size, 'etag': etag, 'last_modified': last_modified, 'fetched_at': int(time.time())}
+        with self._lock:
+            self.index['images'][url] = entry
+        METRICS.inc('mirror_images_total', result='resumed' if resumed else 'downloaded')
+        return entry
+
+    @staticmethod
+    def _expected_size(r: requests.Response, offset: int):
+        if r.status_code == 206:
+            # Content-Range: bytes 1000-4999/5000
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        length = r.headers.get('Content-Length')
+        # a compressed transfer has a Content-Length that differs from the decoded body
+        if length and length.isdigit() and not r.headers.get('Content-Encoding'):
+            return int(length)
+        return None
+
+    @staticmethod
+    def _drop_partial(part: Path, part_meta: Path):
+        part.unlink(missing_ok=True)
+        part_meta.unlink(missing_ok=True)
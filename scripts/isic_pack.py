@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Stichting HUID - alle quizafbeeldingen in één packbestand, geserveerd via mmap.
+
+- images.pack: 8 bytes magic en daarna alleen blobs, alleen ooit aangevuld. Een
+  blob die er al in staat (zelfde SHA-256) wordt niet opnieuw geschreven.
+- images.pack.idx: vaste records (sleutel, offset, lengte, type, SHA-256),
+  gesorteerd op sleutel; opzoeken is bisectie direct op de gemapte bytes.
+  Sleutels zijn <isic_id>/original.jpg en <isic_id>/<breedte>w.<fmt>.
+  De index wordt bij elke export atomair vervangen.
+
+De server beantwoordt GET/HEAD /pack/<sleutel> (met Range, ETag, 304) met een
+memoryview op de mmap van het pack, zonder kopie in Python. Uit --root serveert
+hij alleen de bestanden van de app zelf (STATIC_FILES, STATIC_DIRS); checkpoint,
+cache, archief en .git blijven onbereikbaar en er zijn geen directory-listings.
+
+    python scripts/isic_pack.py --pack data/images.pack --root . --port 8000
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import posixpath
+import re
+import struct
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+PACK_MAGIC = b'HUIDPCK1'
+INDEX_MAGIC = b'HUIDIDX1'
+KEY_SIZE = 48
+HEADER = struct.Struct('<8sII')  # magic, record count, key size
+RECORD = struct.Struct(f'<{KEY_SIZE}sQIB3x32s')  # key, offset, length, type, sha256
+TYPES = ('application/octet-stream', 'image/jpeg', 'image/png', 'image/webp', 'image/avif')
+SUFFIX_TYPES = {'.jpg': 1, '.jpeg': 1, '.png': 2, '.webp': 3, '.avif': 4}
+URL_PATH = '/pack/'
+# what index.html needs from --root; everything else there answers 404
+STATIC_FILES = ('/index.html', '/app.js', '/styles.css', '/data/isic_quiz_sets.json')
+STATIC_DIRS = ('/assets/', '/data/quiz/')
+CHUNK = 1024 * 1024
+
+
+def index_path(pack: Path) -> Path:
+    return Path(str(pack) + '.idx')
+
+
+def _encode_key(key: str) -> bytes:
+    raw = key.encode('utf-8')
+    if len(raw) > KEY_SIZE or b'\0' in raw:
+        raise ValueError(f'pack key too long or invalid: {key!r}')
+    return raw.ljust(KEY_SIZE, b'\0')
+
+
+def _read_records(idx: Path) -> list:
+    try:
+        data = idx.read_bytes()
+    except FileNotFoundError:
+        return []
+    magic, count, key_size = HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or key_size != KEY_SIZE:
+        raise ValueError(f'{idx}: not a pack index')
+    return [RECORD.unpack_from(data, HEADER.size + i * RECORD.size) for i in range(count)]
+
+
+def export(pack: Path, items: Iterable[Tuple[str, Path]], keep: Iterable[str] = ()) -> dict:
+    """Write (key, file) pairs into the pack; the new index holds these keys plus `keep` from the old index.
+
+    Blobs already in the pack are reused by hash, new ones are appended. Returns counts.
+    """
+    pack = Path(pack)
+    idx = index_path(pack)
+    old = _read_records(idx)
+    known = {sha: (offset, length) for _, offset, length, _, sha in old}
+    old_by_key = {r[0]: r[1:] for r in old}
+    pack.parent.mkdir(parents=True, exist_ok=True)
+    if not pack.exists() or pack.stat().st_size < len(PACK_MAGIC):
+        pack.write_bytes(PACK_MAGIC)
+
+    records = {}
+    for key in keep:
+        k = _encode_key(key)
+        if k in old_by_key:
+            records[k] = old_by_key[k]
+    appended = 0
+    with open(pack, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        for key, path in items:
+            data = Path(path).read_bytes()
+            sha = hashlib.sha256(data).digest()
+            if sha not in known:
+                known[sha] = (f.tell(), len(data))
+                f.write(data)
+                appended += len(data)
+            offset, length = known[sha]
+            records[_encode_key(key)] = (offset, length, SUFFIX_TYPES.get(Path(path).suffix.lower(), 0), sha)
+        f.flush()
+        # the index must never point past what is on disk
+        os.fsync(f.fileno())
+
+    out = bytearray(HEADER.pack(INDEX_MAGIC, len(records), KEY_SIZE))
+    for k in sorted(records):
+        out += RECORD.pack(k, *records[k])
+    tmp = idx.with_suffix('.tmp')
+    tmp.write_bytes(out)
+    os.replace(tmp, idx)
+    return {'keys': len(records), 'bytes_appended': appended, 'pack_bytes': pack.stat().st_size}
+
+
+class PackReader:
+    """Read-only view of a pack and its index, both memory-mapped; reloads when the index is replaced."""
+
+    def __init__(self, pack: Path):
+        self.pack = Path(pack)
+        self.idx = index_path(self.pack)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._maps = None
+        self.refresh()
+
+    def refresh(self):
+        st = self.idx.stat()
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            with open(self.idx, 'rb') as fi, open(self.pack, 'rb') as fp:
+                imap = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+                pmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count, key_size = HEADER.unpack_from(imap)
+            if magic != INDEX_MAGIC or key_size != KEY_SIZE or pmap[:len(PACK_MAGIC)] != PACK_MAGIC:
+                raise ValueError(f'{self.pack}: not a pack')
+            # old maps stay valid for responses still being written; they go when unreferenced
+            self._maps = (imap, pmap, count)
+            self._stamp = stamp
+
+    def lookup(self, key: str) -> Optional[Tuple[memoryview, str, str]]:
+        """(body, content type, sha256 hex) for `key`, or None."""
+        try:
+            k = _encode_key(key)
+        except ValueError:
+            return None
+        imap, pmap, count = self._maps
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * RECORD.size
+            if imap[start:start + KEY_SIZE] < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == count:
+            return None
+        rec_key, offset, length, kind, sha = RECORD.unpack_from(imap, HEADER.size + lo * RECORD.size)
+        if rec_key != k:
+            return None
+        return memoryview(pmap)[offset:offset + length], TYPES[kind] if kind < len(TYPES) else TYPES[0], sha.hex()
+
+    def keys(self) -> list:
+        imap, _, count = self._maps
+        return [imap[HEADER.size + i * RECORD.size:HEADER.size + i * RECORD.size + KEY_SIZE].rstrip(b'\0').decode('utf-8')
+                for i in range(count)]
+
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: str, size: int):
+    """(start, end) inclusive for a single byte range; None = whole body; ValueError = unsatisfiable."""
+    m = _RANGE.match((header or '').strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None  # absent, multi-range or malformed: send the whole body
+    if not m.group(1):
+        n = int(m.group(2))
+        if n == 0:
+            raise ValueError('empty suffix range')
+        return max(0, size - n), size - 1
+    start = int(m.group(1))
+    end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError('range outside the body')
+    return start, end
+
+
+class PackHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    reader: PackReader = None
+
+    def do_GET(self):
+        if not self._serve_pack(head=False) and self._static_allowed():
+            super().do_GET()
+
+    def do_HEAD(self):
+        if not self._serve_pack(head=True) and self._static_allowed():
+            super().do_HEAD()
+
+    def _static_allowed(self) -> bool:
+        raw = unquote(urlparse(self.path).path)
+        path = posixpath.normpath(raw)
+        if raw == '/':
+            self.path = '/index.html'
+            return True
+        # no trailing slash: directories would be listed
+        if path in STATIC_FILES or (path.startswith(STATIC_DIRS) and not raw.endswith('/')):
+            return True
+        self.send_error(404)
+        return False
+
+    def _serve_pack(self, head: bool) -> bool:
+        path = urlparse(self.path).path
+        if not path.startswith(URL_PATH):
+            return False
+        self.reader.refresh()
+        found = self.reader.lookup(unquote(path[len(URL_PATH):]))
+        if found is None:
+            self.send_error(404)
+            return True
+        body, content_type, sha = found
+        etag = f'"{sha}"'
+        if etag in (self.headers.get('If-None-Match') or ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return True
+
+        size = len(body)
+        rng = None
+        # If-Range with a different validator means: send the whole (changed) body
+        if self.headers.get('If-Range') in (None, etag):
+            try:
+                rng = parse_range(self.headers.get('Range'), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return True
+        if rng is None:
+            self.send_response(200)
+            part = body
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {rng[0]}-{rng[1]}/{size}')
+            part = body[rng[0]:rng[1] + 1]
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(part)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        self.end_headers()
+        if not head:
+            # unbuffered wfile: slices of the mapped pack go straight to the socket
+            for start in range(0, len(part), CHUNK):
+                self.wfile.write(part[start:start + CHUNK])
+        return True
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(pack: Path, root: Path = Path('.'), host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    handler = partial(type('Handler', (PackHandler,), {'reader': PackReader(pack)}), directory=str(root))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--pack', type=Path, required=True)
+    ap.add_argument('--root', type=Path, default=Path('.'), help='static files next to /pack/ (default: %(default)s)')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8000)
+    args = ap.parse_args()
+
+    server = make_server(args.pack, args.root, args.host, args.port)
+    print(f'serving {args.pack} on http://{args.host}:{server.server_address[1]}{URL_PATH} and {args.root} on /')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
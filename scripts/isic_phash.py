@@ -0,0 +1,167 @@
+"""
+Stichting HUID - bijna-dubbele afbeeldingen herkennen (perceptuele hashes).
+
+Veel oudere ISIC-records hebben geen lesion_id, dus vervolgopnames van dezelfde
+laesie komen door de id-dedup van add_case. Hier krijgt elke gespiegelde
+afbeelding twee 64-bit hashes:
+- pHash: tekens van de laagfrequente 8x8 DCT-coëfficiënten van een 32x32 grijsbeeld
+- dHash: horizontale gradiënten van een 9x8 grijsbeeld
+Beide worden per batch gevectoriseerd met NumPy berekend en per SHA-256 van het
+origineel gecachet in hashes.json naast de spiegel.
+
+Een afbeelding telt als bijna-dubbel als er al een geaccepteerde afbeelding is met
+pHash-afstand <= PHASH_RADIUS én dHash-afstand <= DHASH_RADIUS. Vergelijken gaat
+in één gevectoriseerde XOR/popcount-pass over alle geaccepteerde hashes.
+
+NumPy en Pillow zijn optioneel: zonder werkt de builder, alleen --near-dup niet.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:  # optional dependencies, see available()
+    np = None
+
+PHASH_RADIUS = 10
+DHASH_RADIUS = 12
+BATCH = 256  # images decoded per vectorized hash pass
+
+
+def available() -> bool:
+    return np is not None
+
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8) if np is not None else None
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _dct_matrix(n: int):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m.astype(np.float32)
+
+
+def _pack(bits) -> List[int]:
+    # (N, 64) bools -> N Python ints, first bit most significant
+    return [int(x) for x in np.packbits(bits, axis=1).view('>u8')[:, 0]]
+
+
+def hash_arrays(gray32, gray9x8) -> Tuple[List[int], List[int]]:
+    """Vectorized pHash over (N, 32, 32) and dHash over (N, 8, 9) grayscale arrays."""
+    m = _dct_matrix(32)
+    coeffs = m @ gray32 @ m.T  # batched 2-D DCT-II
+    low = coeffs[:, :8, :8].reshape(len(gray32), 64)
+    # the DC term only measures brightness; leave it out of the median
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    phash = _pack(low > median)
+    dhash = _pack((gray9x8[:, :, 1:] > gray9x8[:, :, :-1]).reshape(len(gray9x8), 64))
+    return phash, dhash
+
+
+def _load(path: Path):
+    with Image.open(path) as im:
+        im.draft('L', (64, 64))  # JPEG: decode at 1/8 scale or smaller
+        im = im.convert('L')
+        return (np.asarray(im.resize((32, 32), Image.LANCZOS), dtype=np.float32),
+                np.asarray(im.resize((9, 8), Image.LANCZOS), dtype=np.float32))
+
+
+class HashCache:
+    """(pHash, dHash) per original SHA-256, kept in <root>/hashes.json."""
+
+    def __init__(self, root: Path):
+        self.path = Path(root) / 'hashes.json'
+        try:
+            self.hashes = {k: tuple(int(x, 16) for x in v) for k, v in json.loads(self.path.read_text(encoding='utf-8')).items()}
+        except (OSError, ValueError):
+            self.hashes = {}
+        self._dirty = False
+
+    def get_many(self, originals: Dict[str, Path]) -> Dict[str, Tuple[int, int]]:
+        """{sha256: path} -> {sha256: (phash, dhash)}; undecodable images are left out."""
+        todo = [d for d in originals if d not in self.hashes]
+        for start in range(0, len(todo), BATCH):
+            digests, g32, g98 = [], [], []
+            for d in todo[start:start + BATCH]:
+                try:
+                    a, b = _load(originals[d])
+                except (OSError, ValueError, Image.DecompressionBombError) as e:
+                    print(f'near-dup: {originals[d]}: {e}')
+                    continue
+                digests.append(d)
+                g32.append(a)
+                g98.append(b)
+            if digests:
+                for d, p, q in zip(digests, *hash_arrays(np.stack(g32), np.stack(g98))):
+                    self.hashes[d] = (p, q)
+                self._dirty = True
+        return {d: self.hashes[d] for d in originals if d in self.hashes}
+
+    def save(self):
+        if not self._dirty:
+            return
+        data = {k: [f'{p:016x}', f'{q:016x}'] for k, (p, q) in self.hashes.items()}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(data, sort_keys=True), encoding='utf-8')
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+def _popcount(x):
+    if hasattr(np, 'bitwise_count'):  # NumPy >= 2.0
+        return np.bitwise_count(x)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(len(x), 8).sum(axis=1)
+
+
+class NearDuplicates:
+    """Accepted images so far; check() before add() rejects near-duplicates of any of them.
+
+    The hashes live in two uint64 arrays and every check is one XOR + popcount pass over
+    all of them. A BK-tree prunes almost nothing at radius 10 in 64-bit space
+    (scripts/bench_phash.py measured it slower than a pure-Python scan).
+    """
+
+    def __init__(self, phash_radius: int = PHASH_RADIUS, dhash_radius: int = DHASH_RADIUS):
+        self.phash_radius = phash_radius
+        self.dhash_radius = dhash_radius
+        self.ids = []
+        self._phash = np.zeros(1024, dtype=np.uint64)
+        self._dhash = np.zeros(1024, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def check(self, case_id: str, hashes: Tuple[int, int]) -> Optional[Tuple[str, int]]:
+        """(id of the closest accepted image, pHash distance) if `hashes` is a near-duplicate, else None."""
+        n = len(self.ids)
+        if not n:
+            return None
+        pd = _popcount(self._phash[:n] ^ np.uint64(hashes[0]))
+        dd = _popcount(self._dhash[:n] ^ np.uint64(hashes[1]))
+        hits = np.flatnonzero((pd <= self.phash_radius) & (dd <= self.dhash_radius))
+        best = None
+        for i in hits[np.argsort(pd[hits], kind='stable')]:
+            if self.ids[i] != case_id:
+                best = (self.ids[i], int(pd[i]))
+                break
+        return best
+
+    def add(self, case_id: str, hashes: Tuple[int, int]):
+        n = len(self.ids)
+        if n == len(self._phash):
+            self._phash = np.concatenate([self._phash, np.zeros(n, dtype=np.uint64)])
+            self._dhash = np.concatenate([self._dhash, np.zeros(n, dtype=np.uint64)])
+        self._phash[n] = hashes[0]
+        self._dhash[n] = hashes[1]
+        self.ids.append(case_id)
@@ -0,0 +1,144 @@
+"""
+Stichting HUID - profiling per stap voor build_isic_sets.py --profile.
+
+Per stap (harvest, build_sets, write_output):
+- cProfile over de hoofdthread én alle threads die tijdens de stap starten -> <stap>.pstats + <stap>.txt
+  (vanaf Python 3.12 één profiler voor het hele proces: cProfile draait op sys.monitoring)
+- een sampler op sys._current_frames() -> collapsed.txt (flamegraph.pl / speedscope)
+- tracemalloc-snapshots -> allocations.txt (top-allocaties en groei per stap)
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+TOP_N = 30
+
+# 3.12+: cProfile sits on sys.monitoring, which is process-wide and takes one profiler at a time.
+# The stage's profiler then already sees every thread, and enabling a second one raises ValueError.
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+class StackSampler(threading.Thread):
+    """Samples every thread's Python stack at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, interval: float = 0.002):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.interval = interval
+        self.stage = 'idle'
+        self.counts = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.append(self.stage)
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class StageProfiler:
+    def __init__(self, out_dir: Path, sample_interval: float = 0.005):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.sampler = StackSampler(sample_interval)
+        self.allocations = []
+        self.timings = {}
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._last_stats = {}
+
+    def start(self):
+        tracemalloc.start()
+        self.sampler.start()
+
+    def _thread_hook(self, *args):
+        # runs as the first profile event of each new thread: swap in a real cProfile
+        sys.setprofile(None)
+        prof = cProfile.Profile()
+        with self._lock:
+            self._thread_profiles.append(prof)
+        prof.enable()
+
+    @contextmanager
+    def stage(self, name: str):
+        self.sampler.stage = name
+        self._thread_profiles = []
+        prof = cProfile.Profile()
+        if PER_THREAD_PROFILES:
+            threading.setprofile(self._thread_hook)
+        t0 = time.perf_counter()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            if PER_THREAD_PROFILES:
+                threading.setprofile(None)
+            self.timings[name] = time.perf_counter() - t0
+            self.sampler.stage = 'idle'
+            # snapshot first: merging and printing the stats allocates enough to top the list
+            self._snapshot(name)
+            self._write_stats(name, prof)
+
+    def _write_stats(self, name: str, prof: cProfile.Profile):
+        stats = pstats.Stats(prof)
+        with self._lock:
+            for p in self._thread_profiles:
+                # worker threads have exited; merging only reads their collected data
+                stats.add(p)
+        stats.dump_stats(str(self.out_dir / f'{name}.pstats'))
+        buf = io.StringIO()
+        pstats.Stats(str(self.out_dir / f'{name}.pstats'), stream=buf).sort_stats('cumulative').print_stats(TOP_N)
+        (self.out_dir / f'{name}.txt').write_text(buf.getvalue(), encoding='utf-8')
+
+    def _snapshot(self, name: str):
+        # one grouping pass per stage; tracemalloc's own compare_to/filter_traces regroup every trace
+        # and take seconds on a heap with a few hundred thousand blocks
+        stats = {s.traceback: s for s in tracemalloc.take_snapshot().statistics('lineno')
+                 if s.traceback[0].filename != tracemalloc.__file__}
+        current, peak = tracemalloc.get_traced_memory()
+        top = sorted(stats.values(), key=lambda s: s.size, reverse=True)[:TOP_N]
+        prev = self._last_stats
+        growth = sorted(
+            ((s.size - (prev[tb].size if tb in prev else 0), s) for tb, s in stats.items()),
+            key=lambda x: x[0], reverse=True,
+        )[:TOP_N]
+        lines = [f'== {name}: current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB, {self.timings[name]:.2f} s', '', '-- top allocations (by line)']
+        lines += [f'  {s}' for s in top]
+        lines += ['', '-- growth during stage']
+        lines += [f'  {s.traceback}: {d / 1024:+.1f} KiB (now {s.size / 1024:.1f} KiB in {s.count} blocks)' for d, s in growth if d > 0]
+        self.allocations.append('\n'.join(lines))
+        self._last_stats = stats
+        tracemalloc.reset_peak()
+
+    def finish(self) -> Path:
+        self.sampler.stop()
+        tracemalloc.stop()
+        with open(self.out_dir / 'collapsed.txt', 'w', encoding='utf-8') as f:
+            for stack, n in sorted(self.sampler.counts.items()):
+                f.write(f'{stack} {n}\n')
+        (self.out_dir / 'allocations.txt').write_text('\n\n'.join(self.allocations) + '\n', encoding='utf-8')
+        summary = '\n'.join(f'{k}\t{v:.3f}s' for k, v in self.timings.items())
+        (self.out_dir / 'stages.txt').write_text(summary + '\n', encoding='utf-8')
+        return self.out_dir
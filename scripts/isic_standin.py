@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Stichting HUID - lokale stand-in voor /api/v2/images/search/ van de ISIC API.
+
+Drie bronnen:
+- --synthetic N : N deterministische records per diagnosis_3 in de query
+                  (optioneel beperkt met isic_id:[ISIC_a TO ISIC_b])
+- --replay DIR  : eerder opgenomen pagina's afspelen (inclusief cursor-keten)
+- --record DIR  : doorsturen naar --upstream en elke pagina opnemen
+
+Latentie, 429's (met Retry-After) en 5xx-fouten zijn in te schakelen. De builder
+draait ertegen met ISIC_SEARCH_URL=http://127.0.0.1:8765/api/v2/images/search/.
+
+    python scripts/isic_standin.py --synthetic 5000 --latency-ms 80 --rate-429 0.02
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import requests
+
+SEARCH_PATH = '/api/v2/images/search/'
+
+
+@dataclass
+class StandinConfig:
+    synthetic: int = 0  # records per diagnosis; 0 = replay/record only
+    histo_rate: float = 0.5
+    replay: Path = None
+    record: Path = None
+    upstream: str = 'https://api.isic-archive.com/api/v2/images/search/'
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    rate_429: float = 0.0
+    retry_after: float = 1.0
+    rate_5xx: float = 0.0
+    seed: int = 0
+
+
+def recording_key(query: str, limit: int) -> str:
+    return hashlib.sha256(f'{query}|{limit}'.encode('utf-8')).hexdigest()[:16]
+
+
+def diagnoses_in(query: str) -> list:
+    return re.findall(r'diagnosis_3:"([^"]+)"', query or '')
+
+
+def synth_record(diagnosis: str, k: int, histo_rate: float) -> dict:
+    # deterministic per (diagnosis, k); ids interleave diagnoses in a stable order
+    h = zlib.crc32(diagnosis.encode('utf-8')) % 1000
+    rnd = random.Random(f'{diagnosis}:{k}')
+    isic_id = f'ISIC_{k * 1000 + h:07d}'
+    lesion = '' if rnd.random() < 0.3 else f'IL_{h:03d}{rnd.randint(0, max(1, k)):06d}'
+    return {
+        'isic_id': isic_id,
+        'copyright_license': 'CC-BY',
+        'files': {
+            'full': {'url': f'https://isic-archive.s3.amazonaws.com/images/{isic_id}.jpg', 'size': 1000 + k},
+            'thumbnail_256': {'url': f'https://isic-archive.s3.amazonaws.com/thumbnails/{isic_id}_thumbnail.jpg'},
+        },
+        'metadata': {
+            'acquisition': {'image_type': 'dermoscopic' if rnd.random() < 0.85 else 'clinical: close-up'},
+            'clinical': {
+                'diagnosis_3': diagnosis,
+                'diagnosis_confirm_type': 'histopathology' if rnd.random() < histo_rate else 'single image expert consensus',
+                'lesion_id': lesion,
+                'age_approx': rnd.choice([35, 45, 55, 65, 75]),
+                'anatom_site_general': rnd.choice(['head/neck', 'upper extremity', 'lower extremity', 'anterior torso', 'posterior torso']),
+            },
+        },
+    }
+
+
+def id_range(query: str):
+    # '... AND isic_id:[ISIC_0000000 TO ISIC_0999999]' -> (0, 999999), bounds inclusive
+    m = re.search(r'isic_id:\[ISIC_(\d+) TO ISIC_(\d+)\]', query or '')
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+def synth_page(query: str, offset: int, limit: int, per_diagnosis: int, histo_rate: float):
+    # an OR query is the merge of its clauses in isic_id order
+    diags = sorted(set(diagnoses_in(query)), key=lambda d: zlib.crc32(d.encode('utf-8')) % 1000)
+    rng = id_range(query)
+    if rng is not None:
+        lo, hi = rng
+        h = {d: zlib.crc32(d.encode('utf-8')) % 1000 for d in diags}
+        matches = [
+            (d, k)
+            for k in range(max(0, (lo - 999) // 1000), min(per_diagnosis - 1, hi // 1000) + 1)
+            for d in diags
+            if lo <= k * 1000 + h[d] <= hi
+        ]
+        return [synth_record(d, k, histo_rate) for d, k in matches[offset:offset + limit]], len(matches)
+    total = per_diagnosis * len(diags)
+    results = []
+    for i in range(offset, min(offset + limit, total)):
+        results.append(synth_record(diags[i % len(diags)], i // len(diags), histo_rate))
+    return results, total
+
+
+class Standin:
+    def __init__(self, cfg: StandinConfig):
+        self.cfg = cfg
+        self.rnd = random.Random(cfg.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.started = time.time()
+
+    def roll(self, rate: float) -> bool:
+        with self.lock:
+            return rate > 0 and self.rnd.random() < rate
+
+    def next_url(self, base: str, query: str, limit: int, cursor: str) -> str:
+        return f'{base}{SEARCH_PATH}?{urlencode({"query": query, "limit": limit, "cursor": cursor})}'
+
+    def page(self, base: str, query: str, limit: int, cursor: str) -> dict:
+        if self.cfg.replay or self.cfg.record:
+            return self.recorded_page(base, query, limit, cursor)
+        offset = int(cursor or 0)
+        results, total = synth_page(query, offset, limit, self.cfg.synthetic, self.cfg.histo_rate)
+        nxt = offset + limit
+        return {
+            'count': total,
+            'next': self.next_url(base, query, limit, str(nxt)) if nxt < total else None,
+            'previous': None,
+            'results': results,
+        }
+
+    def recorded_page(self, base: str, query: str, limit: int, cursor: str) -> dict:
+        root = self.cfg.replay or self.cfg.record
+        d = Path(root) / recording_key(query, limit)
+        idx = int(cursor or 0)
+        path = d / f'page-{idx:04d}.json'
+        if self.cfg.replay:
+            page = json.loads(path.read_text(encoding='utf-8'))
+        else:
+            page = self.record_page(d, idx, query, limit)
+        page = dict(page)
+        # recorded pages keep the upstream cursor; serve our own chain instead
+        page['next'] = self.next_url(base, query, limit, str(idx + 1)) if page.get('next') else None
+        return page
+
+    def record_page(self, d: Path, idx: int, query: str, limit: int) -> dict:
+        d.mkdir(parents=True, exist_ok=True)
+        path = d / f'page-{idx:04d}.json'
+        if path.exists():
+            return json.loads(path.read_text(encoding='utf-8'))
+        if idx == 0:
+            url, params = self.cfg.upstream, {'query': query, 'limit': limit}
+        else:
+            prev = json.loads((d / f'page-{idx - 1:04d}.json').read_text(encoding='utf-8'))
+            url, params = prev['next'], None
+        r = requests.get(url, params=params, timeout=45)
+        r.raise_for_status()
+        page = r.json()
+        (d / 'query.json').write_text(json.dumps({'query': query, 'limit': limit}), encoding='utf-8')
+        path.write_text(json.dumps(page, ensure_ascii=False), encoding='utf-8')
+        return page
+
+
+def make_server(cfg: StandinConfig, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    standin = Standin(cfg)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+        wbufsize = 64 * 1024
+
+        def send_json(self, status: int, body: bytes = b'', headers: dict = None):
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with standin.lock:
+                standin.requests += 1
+            u = urlparse(self.path)
+            if u.path != SEARCH_PATH:
+                return self.send_json(404, b'{"detail": "Not found."}')
+
+            if cfg.latency_ms or cfg.jitter_ms:
+                time.sleep(max(0.0, cfg.latency_ms + random.uniform(-cfg.jitter_ms, cfg.jitter_ms)) / 1000)
+            if standin.roll(cfg.rate_429):
+                return self.send_json(429, b'{"detail": "Request was throttled."}', {'Retry-After': f'{cfg.retry_after:g}'})
+            if standin.roll(cfg.rate_5xx):
+                return self.send_json(random.choice([500, 502, 503]), b'{"detail": "Server error."}')
+
+            q = parse_qs(u.query)
+            query = q.get('query', [''])[0]
+            limit = int(q.get('limit', ['200'])[0])
+            cursor = q.get('cursor', [''])[0]
+            base = f'http://{self.headers.get("Host") or "%s:%d" % self.server.server_address[:2]}'
+            try:
+                page = standin.page(base, query, limit, cursor)
+            except FileNotFoundError:
+                return self.send_json(404, b'{"detail": "No recording for this page."}')
+
+            body = json.dumps(page, ensure_ascii=False).encode('utf-8')
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_json(304, b'', {'ETag': etag})
+            self.send_json(200, body, {'ETag': etag, 'Last-Modified': formatdate(standin.started, usegmt=True)})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.standin = standin
+    return server
+
+
+def start_background(cfg: StandinConfig) -> tuple:
+    """Start a stand-in on a free port; returns (server, search_url)."""
+    server = make_server(cfg)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}{SEARCH_PATH}'
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8765)
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument('--synthetic', type=int, metavar='N', help='records per diagnosis_3 value')
+    src.add_argument('--replay', type=Path, metavar='DIR')
+    src.add_argument('--record', type=Path, metavar='DIR')
+    ap.add_argument('--upstream', default=StandinConfig.upstream)
+    ap.add_argument('--histo-rate', type=float, default=0.5)
+    ap.add_argument('--latency-ms', type=float, default=0.0)
+    ap.add_argument('--jitter-ms', type=float, default=0.0)
+    ap.add_argument('--rate-429', type=float, default=0.0)
+    ap.add_argument('--retry-after', type=float, default=1.0)
+    ap.add_argument('--rate-5xx', type=float, default=0.0)
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    cfg = StandinConfig(
+        synthetic=args.synthetic or 0, histo_rate=args.histo_rate, replay=args.replay, record=args.record,
+        upstream=args.upstream, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+        retry_after=args.retry_after, rate_5xx=args.rate_5xx, seed=args.seed,
+    )
+    server = make_server(cfg, args.host, args.port)
+    print(f'ISIC stand-in on http://{args.host}:{server.server_address[1]}{SEARCH_PATH}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+Stichting HUID - SQLite kandidatenopslag voor de dataset builder.
+
+Geoogste cases staan in één tabel met indexen op isic_id, lesion_id, label en
+bron, zodat uniciteitscontroles en hervatten niet afhangen van het totale
+aantal kandidaten.
+
+Daarnaast een ruw archief van de volledige API-records, zodat quizsets met
+nieuwe filters offline opnieuw gebouwd kunnen worden.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cases (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    label TEXT NOT NULL,
+    isic_id TEXT NOT NULL,
+    lesion_id TEXT NOT NULL DEFAULT '',
+    image_url TEXT NOT NULL,
+    source TEXT NOT NULL,
+    UNIQUE (label, isic_id)
+);
+CREATE INDEX IF NOT EXISTS cases_label_lesion ON cases (label, lesion_id);
+CREATE INDEX IF NOT EXISTS cases_isic_id ON cases (isic_id);
+CREATE INDEX IF NOT EXISTS cases_source ON cases (label, source);
+'''
+
+
+def _row_to_case(row) -> dict:
+    label, isic_id, lesion_id, image_url, source = row
+    return {
+        'id': isic_id,
+        'lesionId': lesion_id,
+        'imageUrl': image_url,
+        'diagnosis': label,
+        'source': source,
+    }
+
+
+class CandidateStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # one connection shared by the harvest threads, serialized by a lock
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def count(self, label: str) -> int:
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM cases WHERE label = ?', (label,)).fetchone()[0]
+
+    def has(self, label: str, column: str, value: str) -> bool:
+        if column not in ('isic_id', 'lesion_id'):
+            raise ValueError(column)
+        with self._lock:
+            row = self.conn.execute(f'SELECT 1 FROM cases WHERE label = ? AND {column} = ? LIMIT 1', (label, value)).fetchone()
+        return row is not None
+
+    def add_many(self, label: str, cases: Iterable[dict]) -> int:
+        rows = [(label, c['id'], c.get('lesionId', '') or '', c['imageUrl'], c['source']) for c in cases]
+        if not rows:
+            return 0
+        # one transaction per page
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO cases (label, isic_id, lesion_id, image_url, source) VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            return self.conn.total_changes - before
+
+    def cases(self, label: str) -> List[dict]:
+        # insertion order, i.e. the order the harvester accepted them in
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT label, isic_id, lesion_id, image_url, source FROM cases WHERE label = ? ORDER BY seq',
+                (label,),
+            ).fetchall()
+        return [_row_to_case(r) for r in rows]
+
+    def first_by_id(self, label: str, n: int) -> List[dict]:
+        # what build_sets needs: the n lowest ids, served from the (label, isic_id) index
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT label, isic_id, lesion_id, image_url, source FROM cases WHERE label = ? ORDER BY isic_id LIMIT ?',
+                (label, n),
+            ).fetchall()
+        return [_row_to_case(r) for r in rows]
+
+    def bucket(self, label: str) -> 'StoreBucket':
+        return StoreBucket(self, label)
+
+
+class _SeenView:
+    """Set-like view for add_case: pending ids in memory, committed ids via the index."""
+
+    def __init__(self, bucket: 'StoreBucket', column: str):
+        self.bucket = bucket
+        self.column = column
+        self.pending = set()
+
+    def __contains__(self, value) -> bool:
+        return value in self.pending or self.bucket.store.has(self.bucket.label, self.column, value)
+
+    def add(self, value):
+        self.pending.add(value)
+
+
+class StoreBucket:
+    """List-like bucket for one label; appends are buffered and written per page by flush()."""
+
+    def __init__(self, store: CandidateStore, label: str):
+        self.store = store
+        self.label = label
+        self.pending: List[dict] = []
+        self.image_ids = _SeenView(self, 'isic_id')
+        self.lesion_ids = _SeenView(self, 'lesion_id')
+        self._count = store.count(label)
+
+    def __len__(self) -> int:
+        return self._count + len(self.pending)
+
+    def append(self, case: dict):
+        self.pending.append(case)
+
+    def flush(self):
+        if self.pending:
+            self._count += self.store.add_many(self.label, self.pending)
+            self.pending = []
+        self.image_ids.pending.clear()
+        self.lesion_ids.pending.clear()
+
+    def __iter__(self):
+        self.flush()
+        return iter(self.store.cases(self.label))
+
+
+class ArchivePage:
+    """Records of one page, compressed in memory as they arrive and appended as one gzip member on close()."""
+
+    def __init__(self, archive: 'RawArchive', label: str):
+        self.archive = archive
+        self.label = label
+        self.ids = []
+        self._z = zlib.compressobj(9, zlib.DEFLATED, 31)  # wbits 31: gzip framing
+        self._parts = []
+
+    def add(self, r: dict):
+        key = (self.label, r.get('isic_id', ''))
+        if not key[1]:
+            return
+        with self.archive._lock:
+            ids = self.archive._load_ids()
+            if key in ids:
+                return
+            ids.add(key)
+        self.ids.append(key[1])
+        line = json.dumps({'label': self.label, 'record': r}, ensure_ascii=False) + '\n'
+        self._parts.append(self._z.compress(line.encode('utf-8')))
+
+    def close(self) -> int:
+        if not self.ids:
+            return 0
+        data = b''.join(self._parts) + self._z.flush()
+        self._parts = []
+        a = self.archive
+        with a._lock:
+            seg = a._current_segment()
+            # one gzip member per page: a crash can only lose the page being written
+            with open(a.root / seg['file'], 'ab') as f:
+                f.write(data)
+            with open(a.ids_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(f'{self.label}\t{i}\n' for i in self.ids))
+            seg['records'] += len(self.ids)
+            seg['labels'][self.label] = seg['labels'].get(self.label, 0) + len(self.ids)
+            a._save_index()
+        return len(self.ids)
+
+    def abort(self):
+        # nothing was written: let a later page archive these records
+        with self.archive._lock:
+            self.archive._ids.difference_update((self.label, i) for i in self.ids)
+        self.ids = []
+        self._parts = []
+
+
+class RawArchive:
+    """Append-only archive of raw ISIC search records: gzip JSONL segments plus a small JSON index.
+
+    Each line is {"label": ..., "record": <full API result>}; a record is kept once per label.
+    """
+
+    SEGMENT_RECORDS = 50000
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / 'index.json'
+        self.ids_path = self.root / 'ids.tsv'
+        self._lock = threading.Lock()
+        self._segment = None
+        self._ids = None
+        try:
+            self.index = json.loads(self.index_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.index = {'version': 1, 'segments': []}
+        # segments written by a run that died before updating the index
+        known = set(s['file'] for s in self.index['segments'])
+        for p in sorted(self.root.glob('segment-*.jsonl.gz')):
+            if p.name not in known:
+                self.index['segments'].append({'file': p.name, 'records': None, 'labels': {}})
+
+    def _load_ids(self) -> set:
+        if self._ids is None:
+            self._ids = set()
+            if self.ids_path.exists():
+                with open(self.ids_path, encoding='utf-8') as f:
+                    for line in f:
+                        label, _, isic_id = line.rstrip('\n').partition('\t')
+                        self._ids.add((label, isic_id))
+        return self._ids
+
+    def _save_index(self):
+        tmp = self.index_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.index, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp, self.index_path)
+
+    def _current_segment(self) -> dict:
+        # every run starts a new segment; long runs rotate every SEGMENT_RECORDS
+        if self._segment is None or (self._segment['records'] or 0) >= self.SEGMENT_RECORDS:
+            n = len(self.index['segments']) + 1
+            self._segment = {'file': f'segment-{n:06d}.jsonl.gz', 'records': 0, 'labels': {}}
+            self.index['segments'].append(self._segment)
+        return self._segment
+
+    def page(self, label: str) -> 'ArchivePage':
+        """Writer for one page of records, fed one record at a time (e.g. from a streamed page)."""
+        return ArchivePage(self, label)
+
+    def records(self, labels: Iterable[str] = None) -> Iterator[tuple]:
+        """Stream (label, record) in archive order, optionally limited to some labels."""
+        wanted = set(labels) if labels is not None else None
+        seen = set()
+        for seg in self.index['segments']:
+            path = self.root / seg['file']
+            if not path.exists():
+                continue
+            if wanted is not None and seg['records'] is not None and not wanted & set(seg['labels']):
+                continue
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            row = json.loads(line)
+                        except ValueError:
+                            break
+                        label = row.get('label')
+                        if wanted is not None and label not in wanted:
+                            continue
+                        key = (label, row['record'].get('isic_id'))
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        yield label, row['record']
+            except (EOFError, OSError, zlib.error):
+                # truncated final gzip member; everything before it is intact
+                continue
+
+    def pages(self, labels: Iterable[str], page_size: int = 200) -> Iterator[dict]:
+        """Archive records shaped like API search pages, for the harvest loops."""
+        chunk = []
+        for _, record in self.records(labels):
+            chunk.append(record)
+            if len(chunk) >= page_size:
+                yield {'results': chunk, 'next': None}
+                chunk = []
+        if chunk:
+            yield {'results': chunk, 'next': None}
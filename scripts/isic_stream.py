@@ -0,0 +1,212 @@
+"""
+Stichting HUID - streaming parse van ISIC-zoekpagina's.
+
+De body van /images/search/ wordt gelezen terwijl hij binnenkomt: elk element van
+"results" wordt los gedecodeerd en doorgegeven, zodat filteren begint voor de
+download klaar is en het geheugen per pagina begrensd blijft tot één record
+(plus de leesbuffer). Andere velden (count, next, previous) zijn beschikbaar
+zodra ze gelezen zijn.
+"""
+
+import codecs
+import json
+from collections import deque
+from types import GeneratorType
+from typing import Callable, Iterable, Iterator
+
+CHUNK_SIZE = 64 * 1024
+_WS = ' \t\n\r'
+_decoder = json.JSONDecoder()
+
+
+class StreamError(ValueError):
+    """The body is not the JSON object we expect, or it ended early."""
+
+
+def iter_page_events(chunks: Iterable[bytes], array_key: str = 'results') -> Iterator[tuple]:
+    """Parse one top-level JSON object from byte chunks.
+
+    Yields ('item', value) for each element of `array_key` and ('key', name, value) for
+    every other top-level member, in body order.
+    """
+    text = codecs.getincrementaldecoder('utf-8')()
+    it = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        for chunk in it:
+            s = text.decode(chunk)
+            if s:
+                # drop what has been consumed so the buffer stays about one chunk long
+                buf = buf[pos:] + s
+                pos = 0
+                return True
+        s = text.decode(b'', final=True)
+        buf = buf[pos:] + s
+        pos = 0
+        eof = True
+        return bool(s)
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WS:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                raise StreamError('unexpected end of body')
+
+    def value():
+        nonlocal pos
+        peek()  # raw_decode does not skip leading whitespace
+        while True:
+            try:
+                v, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if more():
+                    continue
+                raise StreamError(f'invalid JSON value at offset {pos}')
+            # a number (or literal) at the very end of the buffer may continue in the next chunk
+            if end >= len(buf) and not eof and more():
+                continue
+            pos = end
+            return v
+
+    def expect(ch: str):
+        nonlocal pos
+        if peek() != ch:
+            raise StreamError(f'expected {ch!r} at offset {pos}, got {buf[pos]!r}')
+        pos += 1
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        key = value()
+        if not isinstance(key, str):
+            raise StreamError('object key is not a string')
+        expect(':')
+        if key == array_key and peek() == '[':
+            pos += 1
+            if peek() == ']':
+                pos += 1
+            else:
+                while True:
+                    yield ('item', value())
+                    c = peek()
+                    pos += 1
+                    if c == ']':
+                        break
+                    if c != ',':
+                        raise StreamError(f'expected "," or "]" in {array_key}')
+        else:
+            yield ('key', key, value())
+        c = peek()
+        pos += 1
+        if c == '}':
+            return
+        if c != ',':
+            raise StreamError('expected "," or "}" between members')
+
+
+class StreamedPage:
+    """A search page parsed while it downloads; reads like the dict fetch_json returns.
+
+    `results` can be iterated once. get()/[] for other keys read ahead only as far as
+    needed (buffering results passed over on the way). If the connection fails
+    mid-body, the page is requested again through `reopen` and the results already
+    handed out are skipped.
+    """
+
+    def __init__(self, source: Iterable[bytes], reopen: Callable = None, restarts: int = 2, retry_on: tuple = ()):
+        self._reopen = reopen
+        self._restarts = restarts
+        self._retry_on = (StreamError,) + tuple(retry_on)
+        self.head = {}
+        self._pending = deque()
+        self._emitted = 0  # results handed out or buffered, across restarts
+        self._done = False
+        self._results_taken = False
+        self._open(source)
+
+    def _open(self, source):
+        self._source = source
+        self._events = iter_page_events(source)
+        self._skip = self._emitted
+
+    def _advance(self) -> bool:
+        """Parse the next event; False at the end of the body."""
+        while True:
+            try:
+                ev = next(self._events)
+            except StopIteration:
+                self._finish(True)
+                return False
+            except self._retry_on:
+                if self._reopen is None or self._restarts <= 0:
+                    self._finish(False)
+                    raise
+                self._restarts -= 1
+                self._close_source(False)
+                self._open(self._reopen())
+                continue
+            if ev[0] == 'key':
+                self.head.setdefault(ev[1], ev[2])
+                return True
+            if self._skip:
+                self._skip -= 1
+                continue
+            self._emitted += 1
+            self._pending.append(ev[1])
+            return True
+
+    def _close_source(self, complete: bool):
+        # sources may take a completeness flag, e.g. to commit or drop a cache entry
+        close = getattr(self._source, 'close', None)
+        if isinstance(self._source, GeneratorType):
+            close()
+        elif close is not None:
+            close(complete)
+
+    def _finish(self, complete: bool):
+        if not self._done:
+            self._done = True
+            self._close_source(complete)
+
+    def close(self):
+        """Stop reading; an unread remainder is never downloaded."""
+        self._finish(False)
+
+    def get(self, key: str, default=None):
+        if key == 'results':
+            return self.results
+        while key not in self.head and not self._done:
+            self._advance()
+        return self.head.get(key, default)
+
+    def __getitem__(self, key: str):
+        v = self.get(key, KeyError)
+        if v is KeyError:
+            raise KeyError(key)
+        return v
+
+    @property
+    def results(self) -> Iterator[dict]:
+        if self._results_taken:
+            raise RuntimeError('results of a streamed page can only be iterated once')
+        self._results_taken = True
+        return self._iter_results()
+
+    def _iter_results(self) -> Iterator[dict]:
+        while True:
+            while self._pending:
+                yield self._pending.popleft()
+            if self._done or not self._advance():
+                if not self._pending:
+                    return
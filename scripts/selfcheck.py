@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Stichting HUID - zelfcontrole van de builder-onderdelen met veel toestand.
+
+Geen netwerk, geen ISIC-data: alleen tijdelijke bestanden en synthetische input.
+
+- load_ck: journal-replay bovenop de snapshot (seq <= snapshot overgeslagen,
+  afgebroken laatste regel genegeerd, resets, compactie)
+- harvest: een run die halverwege afbreekt bewaart de labels die wel klaar zijn,
+  klinische aanvulling inbegrepen; hervatten vraagt die labels niet opnieuw op
+- isic_http: welke requests-fouten opnieuw geprobeerd worden (reset, timeout,
+  afgebroken of onleesbare body) en welke meteen fataal zijn (onbruikbare URL)
+- IdSet: zelfde antwoorden als set() over toevoegen, samenvoegen en afwijkende ids
+- iter_page_events/StreamedPage: elke opsplitsing in chunks (ook midden in een
+  UTF-8-teken of getal) geeft dezelfde events; herstart na een afgebroken body
+- isic_pack: parse_range-randgevallen, opzoeken via bisectie in de index,
+  hergebruik van blobs en behouden sleutels bij een volgende export
+
+    python scripts/selfcheck.py
+    python scripts/selfcheck.py -v
+"""
+
+import json
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+import requests
+
+import build_isic_sets as builder
+import isic_http
+import isic_pack
+from isic_ids import IdSet
+from isic_stream import StreamError, StreamedPage, iter_page_events
+
+
+def case(i: int, label: str = 'bcc') -> dict:
+    return {'id': f'ISIC_{i:07d}', 'lesionId': '', 'imageUrl': f'u{i}', 'diagnosis': label, 'source': 'histopathology'}
+
+
+class CheckpointReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = builder.CK_PATH, builder.OFFLINE
+        builder.CK_PATH = Path(self.tmp.name) / 'isic_checkpoint.json'
+        builder.OFFLINE = False
+
+    def tearDown(self):
+        builder.CK_PATH, builder.OFFLINE = self.saved
+        self.tmp.cleanup()
+
+    def write_snapshot(self, state: dict):
+        builder.CK_PATH.write_text(json.dumps(state), encoding='utf-8')
+
+    def write_journal(self, *entries, tail: str = ''):
+        lines = ''.join(json.dumps(e) + '\n' for e in entries)
+        builder.ck_journal_path().write_text(lines + tail, encoding='utf-8')
+
+    def test_no_journal_returns_snapshot(self):
+        self.write_snapshot({'buckets': {'bcc': [case(1)]}, 'journal_seq': 3})
+        self.assertEqual(builder.load_ck(), {'buckets': {'bcc': [case(1)]}, 'journal_seq': 3})
+
+    def test_entries_up_to_snapshot_seq_are_skipped(self):
+        # a crash between the snapshot rename and the journal unlink leaves entries 1-2 behind
+        self.write_snapshot({'buckets': {'bcc': [case(1), case(2)]}, 'next_bcc': 'c2', 'journal_seq': 2})
+        self.write_journal(
+            {'seq': 1, 'cursors': {'next_bcc': 'c1'}, 'cases': {'bcc': [case(1)]}},
+            {'seq': 2, 'cursors': {'next_bcc': 'c2'}, 'cases': {'bcc': [case(2)]}},
+            {'seq': 3, 'cursors': {'next_bcc': 'c3'}, 'cases': {'bcc': [case(3)]}},
+        )
+        state = builder.load_ck()
+        self.assertEqual([c['id'] for c in state['buckets']['bcc']], ['ISIC_0000001', 'ISIC_0000002', 'ISIC_0000003'])
+        self.assertEqual(state['next_bcc'], 'c3')
+        self.assertEqual(state['journal_seq'], 3)
+
+    def test_torn_tail_is_ignored(self):
+        self.write_journal(
+            {'seq': 1, 'cursors': {'next_bcc': 'c1'}, 'cases': {'bcc': [case(1)]}},
+            tail='{"seq": 2, "cursors": {"next_bcc": "c2"}, "cases": {"bcc": [{"id": "ISIC_00',
+        )
+        state = builder.load_ck()
+        self.assertEqual([c['id'] for c in state['buckets']['bcc']], ['ISIC_0000001'])
+        self.assertEqual(state['next_bcc'], 'c1')
+        self.assertEqual(state['journal_seq'], 1)
+
+    def test_replay_is_idempotent_per_id(self):
+        self.write_journal(
+            {'seq': 1, 'cursors': {}, 'cases': {'bcc': [case(1), case(2)]}},
+            {'seq': 2, 'cursors': {}, 'cases': {'bcc': [case(2), case(3)]}},
+        )
+        self.assertEqual([c['id'] for c in builder.load_ck()['buckets']['bcc']], ['ISIC_0000001', 'ISIC_0000002', 'ISIC_0000003'])
+
+    def test_reset_empties_a_pool(self):
+        self.write_snapshot({'clinical': {'bcc': [case(1)]}, 'journal_seq': 0})
+        self.write_journal(
+            {'seq': 1, 'cursors': {}, 'resets': {'clinical': ['bcc']}},
+            {'seq': 2, 'cursors': {}, 'pools': {'bcc': [case(5)]}},
+        )
+        self.assertEqual([c['id'] for c in builder.load_ck()['clinical']['bcc']], ['ISIC_0000005'])
+
+    def test_append_then_snapshot_round_trip(self):
+        state = {'buckets': {'bcc': []}}
+        builder.checkpoint_page(state, {'next_bcc': 'c1'}, {'bcc': [case(1)]}, {})
+        builder.checkpoint_page(state, {'next_bcc': 'c2'}, {'bcc': [case(1), case(2)]}, {})
+        replayed = builder.load_ck()
+        self.assertEqual([c['id'] for c in replayed['buckets']['bcc']], ['ISIC_0000001', 'ISIC_0000002'])
+        self.assertEqual(replayed['next_bcc'], 'c2')
+        builder.save_ck(state)
+        self.assertFalse(builder.ck_journal_path().exists())
+        self.assertEqual(builder.load_ck()['journal_seq'], 2)
+
+
+class HarvestResume(unittest.TestCase):
+    """A run that dies mid-harvest keeps every finished label, clinical fallback included."""
+
+    PAGES = 3
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = {k: v for k, v in vars(builder).items() if k.isupper()}
+        self.saved.update(fetch_json=builder.fetch_json, STORE=builder.STORE, ARCHIVE=builder.ARCHIVE, PROFILER=builder.PROFILER)
+        builder.fetch_json = self.fetch
+        self.fail_label = None
+        self.requests = []
+
+    def tearDown(self):
+        for k, v in self.saved.items():
+            setattr(builder, k, v)
+        self.tmp.cleanup()
+
+    def fetch(self, url, params=None, label=''):
+        self.requests.append(label)
+        if params:
+            page = 0
+        else:
+            label, page = url.split('//')[1].split('/')
+            page = int(page)
+        if label == self.fail_label and page == 1:
+            raise RuntimeError('connection lost')
+        diagnosis = builder.LABEL_QUERIES[label].split('"')[1]
+        results = []
+        for i in range(10):
+            n = list(builder.LABEL_QUERIES).index(label) * 1000 + page * 10 + i
+            results.append({'isic_id': f'ISIC_{n:07d}', 'files': {'full': {'url': f'u{n}'}}, 'metadata': {
+                'acquisition': {'image_type': 'dermoscopic'},
+                # one histopathology case per page: the rest of the target comes from the clinical fallback
+                'clinical': {'diagnosis_3': diagnosis, 'lesion_id': '',
+                             'diagnosis_confirm_type': 'histopathology' if i == 0 else 'single image expert consensus'}}})
+        return {'results': results, 'next': f'standin://{label}/{page + 1}' if page + 1 < self.PAGES else None}
+
+    def run_builder(self):
+        builder.main(['--out-dir', self.tmp.name, '--labels', 'nevus,bcc', '--target', '6', '--workers', '2',
+                      '--rps', '1000', '--retries', '1', '--page-size', '10', '--mode', 'per_label',
+                      '--partitions', '1', '--no-cache', '--no-quiz-files'])
+
+    def test_fallback_survives_a_failing_label(self):
+        self.fail_label = 'nevus'
+        with self.assertRaises(RuntimeError):
+            self.run_builder()
+        ck = builder.load_ck()
+        bcc = ck['buckets']['bcc']
+        self.assertEqual(len(bcc), 6)
+        self.assertEqual(sum(c['source'] == 'clinical diagnosis' for c in bcc), 3)
+
+        # resume: bcc is complete, only nevus is walked again
+        self.fail_label = None
+        self.requests.clear()
+        self.run_builder()
+        self.assertNotIn('bcc', self.requests)
+        out = json.loads(builder.OUT_PATH.read_text(encoding='utf-8'))
+        self.assertEqual((out['meta']['counts']['nevus'], out['meta']['counts']['bcc']), (6, 6))
+
+
+class HttpErrorClasses(unittest.TestCase):
+    def setUp(self):
+        self.saved = isic_http.get
+
+    def tearDown(self):
+        isic_http.get = self.saved
+
+    def classify(self, error: Exception):
+        def get(*args, **kwargs):
+            raise error
+        isic_http.get = get
+        try:
+            isic_http._checked_get('https://example.invalid/search')
+        except (isic_http.RetryableError, isic_http.FatalHTTPError) as e:
+            return type(e)
+        self.fail(f'{type(error).__name__} was not raised')
+
+    def test_transient_errors_are_retried(self):
+        for error in (requests.ConnectionError('reset'), requests.ConnectTimeout('connect'), requests.ReadTimeout('read'),
+                      requests.exceptions.ChunkedEncodingError('truncated'), requests.exceptions.ContentDecodingError('gzip'),
+                      requests.exceptions.SSLError('handshake'), requests.RequestException('other')):
+            self.assertIs(self.classify(error), isic_http.RetryableError, type(error).__name__)
+
+    def test_unusable_requests_are_fatal(self):
+        for error in (requests.exceptions.InvalidURL('url'), requests.exceptions.MissingSchema('schema'),
+                      requests.exceptions.InvalidSchema('schema'), requests.exceptions.InvalidHeader('header'),
+                      requests.exceptions.InvalidProxyURL('proxy'), requests.exceptions.TooManyRedirects('loop')):
+            self.assertIs(self.classify(error), isic_http.FatalHTTPError, type(error).__name__)
+
+
+class IdSetMatchesSet(unittest.TestCase):
+    def check(self, values, min_merge: int):
+        ids = IdSet()
+        ids.MIN_MERGE = min_merge
+        ref = set()
+        for v in values:
+            ids.add(v)
+            ref.add(v)
+            self.assertEqual(len(ids), len(ref))
+        for v in values + ['ISIC_9999999', 'IL_0000000', 'ISIC_', '']:
+            self.assertEqual(v in ids, v in ref, v)
+        self.assertEqual(sorted(ids), sorted(ref))
+
+    def test_ascending_duplicates_and_odd_ids(self):
+        values = [f'ISIC_{i:07d}' for i in range(0, 300, 3)]
+        # duplicates, and ids that must not be folded into the integer arrays
+        values += ['ISIC_0000003', 'ISIC_123', 'ISIC_00000030', 'ISIC_000000x', 'IL_0000123', 'IL_0000123', 'lesion']
+        self.check(values, min_merge=4)
+
+    def test_random_order_forces_merges(self):
+        rnd = random.Random(7)
+        values = [f'{rnd.choice(("ISIC_", "IL_"))}{rnd.randrange(5000):07d}' for _ in range(5000)]
+        self.check(values, min_merge=8)
+
+
+PAGE = {
+    'count': 12345,
+    'next': 'https://api.isic-archive.com/api/v2/images/search/?cursor=cD0yMDIz',
+    'results': [
+        {'isic_id': 'ISIC_0000001', 'metadata': {'clinical': {'diagnosis_3': 'Nevus', 'age_approx': 45}}, 'score': 0.5},
+        {'isic_id': 'ISIC_0000002', 'metadata': {'clinical': {'diagnosis_3': 'Basaalcelcarcinoom – ü ✓ 😀'}}, 'n': [1, -2.5e3, None, True]},
+        {'isic_id': 'ISIC_0000003', 'files': {}},
+    ],
+    'previous': None,
+    'last': 1234567890,
+}
+
+
+def split(body: bytes, sizes) -> list:
+    chunks, pos = [], 0
+    for n in sizes:
+        chunks.append(body[pos:pos + n])
+        pos += n
+    return chunks + [body[pos:]]
+
+
+def events(chunks) -> list:
+    return list(iter_page_events(chunks))
+
+
+class StreamParsing(unittest.TestCase):
+    body = json.dumps(PAGE, ensure_ascii=False, indent=1).encode('utf-8')
+    expected = [('key', 'count', 12345), ('key', 'next', PAGE['next'])] + [('item', r) for r in PAGE['results']] + \
+               [('key', 'previous', None), ('key', 'last', 1234567890)]
+
+    def test_whole_body(self):
+        self.assertEqual(events([self.body]), self.expected)
+
+    def test_every_two_way_split(self):
+        # covers splits inside keys, multi-byte characters, numbers and literals
+        for i in range(len(self.body) + 1):
+            self.assertEqual(events([self.body[:i], self.body[i:]]), self.expected, i)
+
+    def test_tiny_and_random_chunks(self):
+        self.assertEqual(events([self.body[i:i + 1] for i in range(len(self.body))]), self.expected)
+        rnd = random.Random(3)
+        for _ in range(200):
+            self.assertEqual(events(split(self.body, [rnd.randint(0, 9) for _ in range(100)])), self.expected)
+
+    def test_empty_results_and_object(self):
+        self.assertEqual(events([b'{"results": [], "next": null}']), [('key', 'next', None)])
+        self.assertEqual(events([b' { } ']), [])
+
+    def test_truncated_body_raises(self):
+        for cut in (1, len(self.body) // 2, len(self.body) - 1):
+            with self.assertRaises(StreamError):
+                events([self.body[:cut]])
+
+    def test_restart_skips_results_already_handed_out(self):
+        body = self.body
+
+        def broken():
+            yield body[:len(body) * 2 // 3]
+            raise StreamError('connection reset')
+
+        page = StreamedPage(broken(), reopen=lambda: iter(split(body, [7] * 50)), restarts=1)
+        self.assertEqual(page.get('count'), 12345)
+        self.assertEqual(list(page.results), PAGE['results'])
+        self.assertEqual(page.get('last'), 1234567890)
+
+    def test_restarts_are_bounded(self):
+        def broken():
+            yield self.body[:40]
+            raise StreamError('connection reset')
+
+        page = StreamedPage(broken(), reopen=broken, restarts=2)
+        with self.assertRaises(StreamError):
+            list(page.results)
+
+
+class PackRanges(unittest.TestCase):
+    def test_whole_body(self):
+        for header in (None, '', 'bytes=', 'bytes=-', 'items=0-1', 'bytes=0-1,4-5', 'bytes=a-b'):
+            self.assertIsNone(isic_pack.parse_range(header, 10), header)
+
+    def test_satisfiable(self):
+        cases = {
+            'bytes=0-0': (0, 0), 'bytes=0-9': (0, 9), 'bytes=2-5': (2, 5), 'bytes=5-': (5, 9),
+            'bytes=0-999': (0, 9),  # end past the body is clipped
+            'bytes=-3': (7, 9), 'bytes=-999': (0, 9), ' bytes=9-9 ': (9, 9),
+        }
+        for header, expected in cases.items():
+            self.assertEqual(isic_pack.parse_range(header, 10), expected, header)
+
+    def test_unsatisfiable(self):
+        for header, size in (('bytes=10-', 10), ('bytes=10-12', 10), ('bytes=5-2', 10), ('bytes=-0', 10), ('bytes=0-', 0)):
+            with self.assertRaises(ValueError, msg=header):
+                isic_pack.parse_range(header, size)
+
+
+class PackIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.pack = self.root / 'images.pack'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def blob(self, name: str, data: bytes) -> Path:
+        path = self.root / name
+        path.write_bytes(data)
+        return path
+
+    def test_lookup_every_key_and_misses(self):
+        rnd = random.Random(5)
+        items = {f'ISIC_{i:07d}/{w}w.webp': self.blob(f'{i}-{w}.webp', rnd.randbytes(rnd.randint(0, 300)))
+                 for i in rnd.sample(range(10 ** 6), 60) for w in (160, 640)}
+        isic_pack.export(self.pack, sorted(items.items()))
+        reader = isic_pack.PackReader(self.pack)
+        self.assertEqual(reader.keys(), sorted(items))
+        for key, path in items.items():
+            body, content_type, _ = reader.lookup(key)
+            self.assertEqual(bytes(body), path.read_bytes(), key)
+            self.assertEqual(content_type, 'image/webp')
+        # before the first key, between keys, after the last, and keys that cannot be encoded
+        for key in ('', 'A', 'ISIC_0000000/1w.webp', sorted(items)[0] + 'x', 'zzz', 'x' * 200, 'a\0b'):
+            self.assertIsNone(reader.lookup(key), key)
+
+    def test_reexport_reuses_blobs_and_keeps_keys(self):
+        a = self.blob('a.jpg', b'a' * 100)
+        b = self.blob('b.jpg', b'b' * 50)
+        first = isic_pack.export(self.pack, [('ISIC_0000001/original.jpg', a)])
+        # same bytes under a new key: nothing appended; the old key survives only through `keep`
+        second = isic_pack.export(self.pack, [('ISIC_0000002/original.jpg', a), ('ISIC_0000003/original.jpg', b)],
+                                  keep=['ISIC_0000001/original.jpg', 'ISIC_0000009/original.jpg'])
+        self.assertEqual(first['bytes_appended'], 100)
+        self.assertEqual(second['bytes_appended'], 50)
+        reader = isic_pack.PackReader(self.pack)
+        self.assertEqual(reader.keys(), ['ISIC_0000001/original.jpg', 'ISIC_0000002/original.jpg', 'ISIC_0000003/original.jpg'])
+        self.assertEqual(bytes(reader.lookup('ISIC_0000001/original.jpg')[0]), b'a' * 100)
+        isic_pack.export(self.pack, [('ISIC_0000003/original.jpg', b)])
+        reader.refresh()
+        self.assertEqual(reader.keys(), ['ISIC_0000003/original.jpg'])
+        self.assertEqual(bytes(reader.lookup('ISIC_0000003/original.jpg')[0]), b'b' * 50)
+
+
+if __name__ == '__main__':
+    unittest.main()